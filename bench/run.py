@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+
+# Benchmarks for the player, queue and control paths. Everything runs
+# against a throwaway redis-server and GStreamer generated audio, with
+# the player outputting to a fakesink and reading keys from a pty, so
+# nothing on the machine running it is touched.
+#
+#     python3 bench/run.py [--output results.json] [--compare old.json]
+#
+# Needs redis-server, gst-launch-1.0 (with flacenc) and deck's own
+# requirements installed.
+
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import redis
+
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+METRICS_PORT = 9199
+
+
+class Bench:
+    def __init__(self, workdir, sizes, idle_seconds):
+        self.workdir = workdir
+        self.sizes = sizes
+        self.idle_seconds = idle_seconds
+        self.results = {}
+        self.socket = os.path.join(workdir, 'redis.sock')
+        self.env = dict(
+            os.environ,
+            DECK_REDIS_URL='unix://%s' % self.socket,
+            DECK_SOCKET=os.path.join(workdir, 'deck.sock'),
+            DECK_AUDIO_SINK='fakesink sync=true',
+            PYTHONPATH=REPO,
+        )
+        # no scrobbling from benchmark runs
+        for name in ['LASTFM_KEY', 'LASTFM_SECRET', 'LASTFM_USER', 'LASTFM_PASS']:
+            self.env.pop(name, None)
+        self.redis_server = None
+        self.player = None
+        self.pty = None
+
+    def start_redis(self):
+        self.redis_server = subprocess.Popen(
+            [
+                'redis-server',
+                '--port', '0',
+                '--unixsocket', self.socket,
+                '--save', '',
+                '--appendonly', 'no',
+            ],
+            stdout=subprocess.DEVNULL,
+        )
+        self.redis = redis.Redis(unix_socket_path=self.socket)
+        wait_for(lambda: os.path.exists(self.socket), 'redis-server')
+        wait_for(self.redis_ping, 'redis-server')
+
+    def redis_ping(self):
+        try:
+            return self.redis.ping()
+        except redis.exceptions.ConnectionError:
+            return False
+
+    def redis_commands(self):
+        # everything except the commands the benchmark itself sends
+        ignored = ['cmdstat_info', 'cmdstat_llen', 'cmdstat_ping', 'cmdstat_flushall']
+        return sum(
+            stats['calls']
+            for name, stats in self.redis.info('commandstats').items()
+            if name not in ignored
+        )
+
+    def generate_track(self, path, seconds, number):
+        buffers = max(1, int(seconds * 10))
+        subprocess.run(
+            [
+                'gst-launch-1.0', '-q',
+                'audiotestsrc', 'num-buffers=%d' % buffers,
+                'samplesperbuffer=4410', 'freq=%d' % (220 + number * 20),
+                '!', 'audio/x-raw,rate=44100,channels=2',
+                '!', 'audioconvert',
+                '!', 'taginject',
+                'tags=title=track%03d,artist=bench,album=bench,track-number=%d'
+                % (number, number),
+                '!', 'flacenc',
+                '!', 'filesink', 'location=%s' % path,
+            ],
+            check=True,
+        )
+
+    def generate_tracks(self, name, count, seconds):
+        directory = os.path.join(self.workdir, name)
+        os.makedirs(directory, exist_ok=True)
+        tracks = []
+        for number in range(1, count + 1):
+            path = os.path.join(directory, '%03d.flac' % number)
+            if not os.path.exists(path):
+                self.generate_track(path, seconds, number)
+            tracks.append(path)
+        return tracks
+
+    def generate_tree(self, count):
+        # copies rather than links, so every file has its own identity
+        source = os.path.join(self.workdir, 'tiny.flac')
+        if not os.path.exists(source):
+            self.generate_track(source, 0.1, 1)
+        root = os.path.join(self.workdir, 'tree-%d' % count)
+        playlist = os.path.join(self.workdir, 'tree-%d.m3u' % count)
+        with open(playlist, 'w') as m3u:
+            for number in range(count):
+                directory = os.path.join(root, '%04d' % (number // 100))
+                os.makedirs(directory, exist_ok=True)
+                path = os.path.join(directory, '%03d.flac' % (number % 100))
+                shutil.copyfile(source, path)
+                m3u.write(path + '\n')
+        return root, playlist
+
+    def deck(self, *args, input=None):
+        return subprocess.run(
+            [sys.executable, '-m', 'deck.cli', *args],
+            env=self.env,
+            cwd=REPO,
+            input=input,
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+
+    def start_player(self, *args, env=None):
+        master, slave = os.openpty()
+        self.player = subprocess.Popen(
+            [
+                sys.executable, '-m', 'deck.cli', 'spin',
+                '--metrics-port', str(METRICS_PORT), *args,
+            ],
+            env=env or self.env,
+            cwd=REPO,
+            stdin=slave,
+            stdout=slave,
+            stderr=slave,
+            start_new_session=True,
+        )
+        os.close(slave)
+        self.pty = master
+        # the player blocks if nothing reads what it draws
+        threading.Thread(target=self.drain_pty, daemon=True).start()
+        wait_for(self.metrics_available, 'player metrics')
+
+    def drain_pty(self):
+        try:
+            while os.read(self.pty, 4096):
+                pass
+        except OSError:
+            pass
+
+    def press(self, key):
+        os.write(self.pty, key.encode())
+
+    def stop_player(self):
+        if self.player:
+            # ^C, as the terminal is in raw mode
+            self.press('\x03')
+            try:
+                self.player.wait(5)
+            except subprocess.TimeoutExpired:
+                self.player.kill()
+                self.player.wait()
+            os.close(self.pty)
+            self.player = None
+
+    def metrics_available(self):
+        try:
+            self.metrics()
+            return True
+        except OSError:
+            return False
+
+    def metrics(self):
+        url = 'http://localhost:%d/metrics' % METRICS_PORT
+        with urllib.request.urlopen(url, timeout=1) as response:
+            text = response.read().decode()
+        values = {}
+        for line in text.splitlines():
+            match = re.match(r'^(\w+) (\S+)$', line)
+            if match:
+                values[match.group(1)] = float(match.group(2))
+        return values
+
+    def cpu_seconds(self):
+        with open('/proc/%d/stat' % self.player.pid) as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+        # utime and stime, in clock ticks
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    def reset(self):
+        self.stop_player()
+        self.redis.flushall()
+
+    def played(self):
+        return self.redis.llen('deck:recently_played')
+
+    def bench_playback(self, name, *args):
+        # inter-track gap and redis traffic for tracks played through
+        self.reset()
+        tracks = self.generate_tracks('short', 6, 2)
+        self.deck('queue', *tracks)
+        self.start_player(*args)
+        commands = self.redis_commands()
+        wait_for(lambda: self.played() >= len(tracks), 'tracks to play', 60)
+        commands = self.redis_commands() - commands
+        metrics = self.metrics()
+        self.results['%s_gap_mean_seconds' % name] = mean(metrics, 'deck_track_gap_seconds')
+        self.results['%s_redis_ops_per_track' % name] = commands / len(tracks)
+
+    def bench_skip(self):
+        self.reset()
+        tracks = self.generate_tracks('long', 12, 30)
+        self.deck('queue', *tracks)
+        self.start_player()
+        time.sleep(2)
+        before = self.metrics()
+        for _ in range(10):
+            self.press('x')
+            time.sleep(1)
+        after = self.metrics()
+        self.results['skip_to_audio_mean_seconds'] = mean_between(
+            before, after, 'deck_queue_to_audio_seconds',
+        )
+
+    def bench_commands(self):
+        self.reset()
+        tracks = self.generate_tracks('long', 12, 30)
+        self.deck('queue', *tracks)
+        self.start_player()
+        time.sleep(2)
+        before = self.metrics()
+        started = time.monotonic()
+        for _ in range(20):
+            self.deck('pause')
+        elapsed = time.monotonic() - started
+        after = self.metrics()
+        self.results['command_latency_mean_seconds'] = mean_between(
+            before, after, 'deck_command_latency_seconds',
+        )
+        self.results['command_cli_wall_seconds'] = elapsed / 20
+
+    def bench_idle(self):
+        self.reset()
+        self.start_player()
+        time.sleep(2)
+        cpu = self.cpu_seconds()
+        commands = self.redis_commands()
+        time.sleep(self.idle_seconds)
+        self.results['idle_cpu_seconds_per_minute'] = (
+            (self.cpu_seconds() - cpu) * 60 / self.idle_seconds
+        )
+        self.results['idle_redis_ops_per_minute'] = (
+            (self.redis_commands() - commands) * 60 / self.idle_seconds
+        )
+
+    def bench_queue(self):
+        self.reset()
+        for size in self.sizes:
+            root, playlist = self.generate_tree(size)
+            for name, target in [('tree', root), ('m3u', playlist)]:
+                self.redis.flushall()
+                started = time.monotonic()
+                self.deck('queue', target)
+                elapsed = time.monotonic() - started
+                self.results['queue_%s_%d_tracks_per_second' % (name, size)] = (
+                    size / elapsed
+                )
+            self.redis.flushall()
+            with open(playlist, 'rb') as m3u:
+                paths = m3u.read()
+            started = time.monotonic()
+            self.deck('queue', '-', input=paths)
+            elapsed = time.monotonic() - started
+            self.results['queue_stdin_%d_tracks_per_second' % size] = size / elapsed
+
+    def bench_storage(self):
+        # how long the player takes to start, and the memory it takes
+        # with each backend; for redis, the server's memory counts too
+        database = os.path.join(self.workdir, 'deck.db')
+        backends = {
+            'redis': (self.env, [self.redis_server.pid]),
+            'sqlite': (dict(self.env, DECK_STORAGE='sqlite://' + database), []),
+        }
+        for name, (env, servers) in backends.items():
+            self.reset()
+            for path in [env['DECK_SOCKET'], database, database + '-wal', database + '-shm']:
+                if os.path.exists(path):
+                    os.unlink(path)
+            started = time.monotonic()
+            self.start_player(env=env)
+            # the control socket is the last thing set up
+            wait_for(lambda: os.path.exists(env['DECK_SOCKET']), 'control socket', 30)
+            self.results['startup_%s_seconds' % name] = time.monotonic() - started
+            time.sleep(2)
+            self.results['rss_%s_bytes' % name] = sum(
+                resident_memory(pid) for pid in [self.player.pid, *servers]
+            )
+
+    def run(self, only):
+        self.start_redis()
+        benchmarks = {
+            'playback': lambda: self.bench_playback('playback'),
+            'gapless': lambda: self.bench_playback('gapless', '--gapless'),
+            'skip': self.bench_skip,
+            'commands': self.bench_commands,
+            'idle': self.bench_idle,
+            'queue': self.bench_queue,
+            'storage': self.bench_storage,
+        }
+        try:
+            for name, benchmark in benchmarks.items():
+                if only and name not in only:
+                    continue
+                print('running %s' % name, file=sys.stderr)
+                benchmark()
+        finally:
+            self.stop_player()
+            self.redis_server.terminate()
+            self.redis_server.wait()
+        return self.results
+
+
+def wait_for(check, what, timeout=10):
+    started = time.monotonic()
+    while not check():
+        if time.monotonic() - started > timeout:
+            raise RuntimeError('timed out waiting for %s' % what)
+        time.sleep(0.05)
+
+
+def resident_memory(pid):
+    with open('/proc/%d/status' % pid) as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def mean(metrics, name):
+    count = metrics.get('%s_count' % name, 0)
+    if not count:
+        return None
+    return metrics['%s_sum' % name] / count
+
+
+def mean_between(before, after, name):
+    count = after.get('%s_count' % name, 0) - before.get('%s_count' % name, 0)
+    if not count:
+        return None
+    total = after['%s_sum' % name] - before.get('%s_sum' % name, 0)
+    return total / count
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=REPO,
+            capture_output=True,
+            check=True,
+        ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(old, new):
+    for name, value in sorted(new['results'].items()):
+        previous = old['results'].get(name)
+        if value is None or not previous:
+            change = ''
+        else:
+            change = '%+.1f%%' % ((value - previous) / previous * 100)
+        print('%-45s %12s %12s %9s' % (
+            name,
+            '-' if previous is None else '%.6g' % previous,
+            '-' if value is None else '%.6g' % value,
+            change,
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output')
+    parser.add_argument('--compare')
+    parser.add_argument('--sizes', default='10000,100000')
+    parser.add_argument('--idle-seconds', type=int, default=60)
+    parser.add_argument('--only', action='append')
+    args = parser.parse_args()
+
+    sha = commit()
+    output = args.output or os.path.join(REPO, 'bench', 'results', '%s.json' % sha)
+    with tempfile.TemporaryDirectory(prefix='deck-bench-') as workdir:
+        bench = Bench(
+            workdir,
+            [int(size) for size in args.sizes.split(',')],
+            args.idle_seconds,
+        )
+        results = {
+            'commit': sha,
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'results': bench.run(args.only),
+        }
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+    print('results written to %s' % output, file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), results)
+
+
+if __name__ == '__main__':
+    main()
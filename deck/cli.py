@@ -1,4 +1,6 @@
 import click
+from deck.library import library
+from deck.loudness import analyse
 from deck.player import (
     interrupt,
     next_track,
@@ -7,6 +9,7 @@ from deck.player import (
     previous_track,
     queue,
     quit,
+    show_history,
     show_playing,
     show_previous,
     show_queue,
@@ -15,24 +18,34 @@ from deck.player import (
     spin,
     stop,
 )
+from deck.search import search
+from deck.smart import rate, smart
+from deck.tagcache import cache
 
 
 @click.group()
 def cli():
     pass
 
+cli.add_command(analyse)
+cli.add_command(cache)
 cli.add_command(interrupt)
+cli.add_command(library)
 cli.add_command(pause)
 cli.add_command(next_track, name='next')
 cli.add_command(play)
 cli.add_command(previous_track, name='previous')
 cli.add_command(queue)
 cli.add_command(quit)
+cli.add_command(rate)
+cli.add_command(search)
+cli.add_command(show_history)
 cli.add_command(show_playing)
 cli.add_command(show_previous)
 cli.add_command(show_queue)
 cli.add_command(show_summary)
 cli.add_command(skip)
+cli.add_command(smart)
 cli.add_command(spin)
 cli.add_command(stop)
 
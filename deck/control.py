@@ -0,0 +1,108 @@
+import atexit
+import json
+import os
+import socket
+import socketserver
+import sys
+import time
+from uuid import uuid4
+from deck import renderer, storage
+
+
+# how long anything waits for the player to act on a command
+ACK_TIMEOUT = 5
+
+
+def socket_path():
+    path = os.environ.get('DECK_SOCKET')
+    if path:
+        return path
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        return os.path.join(runtime, 'deck.sock')
+    return '/tmp/deck-%d.sock' % os.getuid()
+
+
+def request(message):
+    # returns None when there is no player listening on the socket,
+    # so the caller can fall back to going through redis
+    path = socket_path()
+    if not os.path.exists(path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(ACK_TIMEOUT + 1)
+            sock.connect(path)
+            sock.sendall(json.dumps(message).encode() + b'\n')
+            response = sock.makefile('rb').readline()
+    except (ConnectionRefusedError, FileNotFoundError, socket.timeout):
+        return None
+    if not response:
+        return None
+    return json.loads(response.decode())
+
+
+def error(text):
+    renderer.shared().text('** ' + text)
+
+
+def command_request(command, wait=False):
+    return {
+        'command': command,
+        'id': uuid4().hex,
+        'wait': wait,
+        'sent': time.time(),
+    }
+
+
+def send_command(command, wait=False):
+    # talk to the player directly when it has a control socket open,
+    # which also always waits for the command to be acted on
+    response = request({'command': command, 'sent': time.time()})
+    if response:
+        if not response['ok']:
+            error('"%s" FAILED: %s' % (command, response['error']))
+            sys.exit(1)
+        return
+
+    redis = storage.connect()
+    message = command_request(command, wait)
+    redis.rpush('commands', json.dumps(message))
+    if wait:
+        ack = redis.blpop('ack:%s' % message['id'], timeout=ACK_TIMEOUT)
+        if not ack:
+            error('NO ACKNOWLEDGEMENT FOR "%s"' % command)
+            sys.exit(1)
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    # one JSON object per line in, one JSON object per line out
+    def handle(self):
+        for line in self.rfile:
+            try:
+                message = json.loads(line.decode())
+                response = self.server.player.control(message)
+            except (ValueError, KeyError, TypeError):
+                response = {'ok': False, 'error': 'bad request'}
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class ControlServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, player):
+        self.player = player
+        self.path = socket_path()
+        if os.path.exists(self.path):
+            # a previous player exited without cleaning up
+            os.unlink(self.path)
+        super().__init__(self.path, ControlHandler)
+        os.chmod(self.path, 0o600)
+        atexit.register(self.close)
+
+    def close(self):
+        self.server_close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,303 @@
+from mimetypes import guess_type
+import os
+from select import select
+import sys
+import time
+from itertools import islice
+from deck import library, playqueue, renderer, search, storage
+from deck.playlist import is_playlist, read_playlist
+from deck.playqueue import QUEUE_KEYS
+from deck.tagcache import cached_tracks
+from deck.tracks import path_id, track_id, track_record, walk_directory
+
+
+# tracks written to the queue per round trip
+BATCH_SIZE = 500
+
+# files read from a stream are queued in batches that start small (so
+# the first track can play straight away) and double up to BATCH_SIZE;
+# a partial batch is queued once input stops for STREAM_IDLE, or once
+# STREAM_INTERVAL has passed since the last
+STREAM_FIRST_BATCH = 8
+STREAM_IDLE = 0.2
+STREAM_INTERVAL = 1.0
+STREAM_READ_SIZE = 64 * 1024
+
+
+def error(text):
+    renderer.shared().text('** ' + text)
+
+
+class Enqueuer:
+    # collects tracks and adds them to the queue in batches; each batch
+    # is one MULTI/EXEC, so spin never sees half of a batch; incremental
+    # enqueuers queue each batch as it is ready (calling notify after
+    # each), the others are left for the caller to queue all at once
+    def __init__(self, prepend=False, batch_size=BATCH_SIZE, notify=None):
+        self.redis = storage.connect()
+        self.prepend = prepend
+        self.batch_size = batch_size
+        self.incremental = batch_size != float('inf')
+        self.notify = notify
+        # set while streaming with prepend, see queue_stream
+        self.ahead = False
+        self.last_id = None
+        # the playlists being read, to catch any that include themselves
+        self.playlists = set()
+        self.files = []
+        self.tracks = []
+        self.records = {}
+        self.ids = []
+        self.queued = 0
+        self.batches = 0
+        self.started = time.monotonic()
+        self.flushed = self.started
+
+    def add(self, file, track=None):
+        # tags are read a batch at a time, so the tag cache is asked
+        # about a whole batch in one round trip
+        self.files.append((file, track))
+        if len(self.files) >= self.batch_size:
+            self.flush()
+
+    def reserve(self, count):
+        # keeps a directory within one batch, unless it is too big
+        # to fit in one anyway
+        if len(self.files) + count > self.batch_size:
+            self.flush()
+
+    def read_tags(self):
+        read = iter(cached_tracks(self.redis, [
+            file for file, track in self.files if track is None
+        ]))
+        for file, track in self.files:
+            if track is None:
+                track = next(read)
+            self.tracks.append(track)
+            self.records[track['id']] = track_record(track)
+            self.ids.append(track['id'])
+        self.files = []
+
+    def flush(self):
+        self.flushed = time.monotonic()
+        self.read_tags()
+        if not self.ids:
+            return
+        pipeline = self.redis.pipeline()
+        pipeline.hset_many('tracks', self.records)
+        # when prepending, tracks are added in reverse (each one going
+        # ahead of the last), so the batch is put back in play order;
+        # when streaming ahead of the queue, each batch goes after
+        # the last (or at the head, if that has been played already)
+        after = self.ahead and self.last_id
+        if after:
+            playqueue.insert(pipeline, self.ids, after=after)
+        elif self.prepend or self.ahead:
+            ids = self.ids if self.ahead else reversed(self.ids)
+            pipeline.script('push_tracks', QUEUE_KEYS, [1, *ids])
+        else:
+            pipeline.script('push_tracks', QUEUE_KEYS, [0, *self.ids])
+        if pipeline.execute()[-1] is None and after:
+            playqueue.push(self.redis, self.ids, head=True)
+        if self.ahead:
+            self.last_id = self.ids[-1]
+        search.index_tracks(self.redis, self.tracks)
+        self.queued += len(self.ids)
+        self.batches += 1
+        if self.batch_size < BATCH_SIZE:
+            # (streams start with small batches, see queue_stream)
+            self.batch_size = min(self.batch_size * 2, BATCH_SIZE)
+        self.tracks = []
+        self.records = {}
+        self.ids = []
+        if self.notify:
+            self.notify()
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started
+        rate = self.queued / elapsed if elapsed else 0
+        return '%d tracks in %d batches, %.2fs (%.0f tracks/s)' % (
+            self.queued,
+            self.batches,
+            elapsed,
+            rate,
+        )
+
+
+def queue_file(file, enqueuer, track=None):
+    if os.path.exists(file):
+        guessed_type = guess_type(file)[0]
+        if is_playlist(file):
+            queue_playlist(file, enqueuer)
+        elif guessed_type and guessed_type.startswith('audio/'):
+            enqueuer.add(file, track)
+        else:
+            error('UNKNOWN FILE TYPE "%s"' % file)
+    else:
+        error('NO FILE "%s"' % file)
+
+
+def extinf_track(file, tags, real_dirs):
+    # a track from what a playlist says about it, without opening the
+    # file; it is marked partial, and its own tags are read when it
+    # comes to be played (see complete_track in deck.tagcache)
+    if os.path.islink(file):
+        path = os.path.realpath(file)
+    else:
+        # playlists tend to list many files from few directories, so
+        # each directory is only resolved once
+        dir, name = os.path.split(file)
+        if dir not in real_dirs:
+            real_dirs[dir] = os.path.realpath(dir)
+        path = os.path.join(real_dirs[dir], name)
+    return {'id': path_id(path), 'file': path, 'tags': tags, 'partial': True}
+
+
+def queue_playlist(file, enqueuer):
+    path = os.path.realpath(file)
+    if path in enqueuer.playlists:
+        error('PLAYLIST INCLUDES ITSELF "%s"' % file)
+        return
+    enqueuer.playlists.add(path)
+    try:
+        # a batch at a time, so the library is asked about a whole
+        # batch at once; prepending needs the whole playlist first, to
+        # queue it from the end
+        entries = read_playlist(file)
+        real_dirs = {}
+        batches = iter(lambda: list(islice(entries, BATCH_SIZE)), [])
+        if enqueuer.prepend:
+            batches = reversed(list(batches))
+        for batch in batches:
+            queue_paths([entry for entry, tags in batch], enqueuer, known={
+                entry: extinf_track(entry, tags, real_dirs)
+                for entry, tags in batch
+                if tags and not is_playlist(entry)
+            })
+    except OSError as e:
+        error('CANNOT READ "%s": %s' % (file, e.strerror))
+    finally:
+        enqueuer.playlists.discard(path)
+
+
+def queue_directory(dir, enqueuer):
+    # a directory in the library is listed from the index, with no need
+    # to look at the disk, and only holds audio files
+    indexed = library.indexed_files(enqueuer.redis, dir, reverse=enqueuer.prepend)
+    if indexed is None:
+        for files in walk_directory(dir, reverse=enqueuer.prepend):
+            enqueuer.reserve(len(files))
+            queue_paths(files, enqueuer)
+        return
+    for files in indexed:
+        enqueuer.reserve(len(files))
+        if enqueuer.prepend:
+            files = reversed(files)
+        for file in files:
+            enqueuer.add(file)
+
+
+def read_lines(stream):
+    # lists of lines as they arrive, and None whenever none have for
+    # STREAM_IDLE; nothing more is read until the caller has dealt with
+    # the last, so a producer faster than the queue is held back by the
+    # pipe filling up
+    fd = stream.fileno()
+    pending = b''
+    while True:
+        if not select([fd], [], [], STREAM_IDLE)[0]:
+            yield None
+            select([fd], [], [])
+        data = os.read(fd, STREAM_READ_SIZE)
+        if not data:
+            break
+        *lines, pending = (pending + data).split(b'\n')
+        yield [os.fsdecode(line) for line in lines]
+    if pending:
+        yield [os.fsdecode(pending)]
+
+
+def queue_stream(stream, enqueuer):
+    # files are queued as they are read rather than once the stream
+    # ends; when prepending, the stream goes ahead of what was queued
+    # already, in the order read, a batch at a time
+    if not enqueuer.incremental:
+        queue_paths([line.rstrip() for line in stream], enqueuer)
+        return
+    if enqueuer.prepend:
+        enqueuer.prepend = False
+        enqueuer.ahead = True
+    enqueuer.batch_size = STREAM_FIRST_BATCH
+    for lines in read_lines(stream):
+        if lines is not None:
+            queue_paths([line.rstrip() for line in lines if line.strip()], enqueuer)
+            if time.monotonic() - enqueuer.flushed < STREAM_INTERVAL:
+                continue
+        enqueuer.flush()
+
+
+def queue_files(files, enqueuer):
+    if files and files[0] == '-':
+        queue_stream(sys.stdin, enqueuer)
+    else:
+        queue_paths(files, enqueuer)
+
+
+def queue_paths(files, enqueuer, known={}):
+    # known are tracks already made for some of the files, which the
+    # library index overrides (they are still checked like any other)
+    indexed = library.lookup(enqueuer.redis, files)
+    if enqueuer.prepend:
+        files = reversed(files)
+    for file in files:
+        if file in indexed:
+            enqueuer.add(file, indexed[file])
+        elif file in known:
+            queue_file(file, enqueuer, known[file])
+        elif os.path.isdir(file):
+            queue_directory(file, enqueuer)
+        else:
+            queue_file(file, enqueuer)
+
+
+def queue_entries(files):
+    # track IDs and records, in play order, as replace_queue_entries
+    # takes them; they can be kept to replace the queue with again
+    enqueuer = Enqueuer(batch_size=float('inf'))
+    queue_files(files, enqueuer)
+    enqueuer.read_tags()
+    entries = []
+    for id in enqueuer.ids:
+        entries += [id, enqueuer.records[id]]
+    return entries
+
+
+def replace_queue_entries(redis, entries, command=''):
+    # the whole queue is swapped for the new tracks (and the command
+    # sent to the player) in one atomic round trip
+    redis.script(
+        'replace_queue',
+        QUEUE_KEYS + ['tracks', 'commands'],
+        [command, *entries],
+    )
+
+
+def insert_after(files, after):
+    # new entries go straight after the first queued entry of a track;
+    # returns None when that track is not queued
+    enqueuer = Enqueuer(batch_size=float('inf'))
+    queue_files(files, enqueuer)
+    enqueuer.read_tags()
+    if not enqueuer.ids:
+        return 0
+    pipeline = enqueuer.redis.pipeline()
+    pipeline.hset_many('tracks', enqueuer.records)
+    playqueue.insert(pipeline, enqueuer.ids, after=track_id(after))
+    return pipeline.execute()[-1]
+
+
+def enqueue(files, prepend=False, notify=None):
+    enqueuer = Enqueuer(prepend, notify=notify)
+    queue_files(files, enqueuer)
+    enqueuer.flush()
+    return enqueuer
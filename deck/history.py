@@ -0,0 +1,81 @@
+import json
+
+
+# every play is kept forever: the entries by play number, an index of
+# them by start time, and one per track (see finish_track in
+# deck.redis.SCRIPTS)
+HISTORY_KEYS = ['history', 'history:by_time', 'history:serial']
+
+# and, for asking about every track at once, each track's play count
+# and when it was last played
+PLAY_STATS_KEYS = ['history:plays', 'history:last_played']
+
+
+def track_key(id):
+    if isinstance(id, bytes):
+        id = id.decode()
+    return 'history:track:%s' % id
+
+
+def history_keys(id):
+    return HISTORY_KEYS + [track_key(id)] + PLAY_STATS_KEYS
+
+
+def history_entry(track, started, listened, skipped):
+    return json.dumps({
+        'id': track['id'],
+        'started': started,
+        'listened': round(listened, 3),
+        'skipped': skipped,
+    })
+
+
+def load_plays(redis, plays):
+    if not plays:
+        return []
+    return [
+        json.loads(entry.decode())
+        for entry in redis.hmget('history', plays)
+        if entry
+    ]
+
+
+def recent_plays(redis, count):
+    # oldest first (a count of 0 would be zrange -0 -1, ie. everything)
+    if count <= 0:
+        return []
+    return load_plays(redis, redis.zrange('history:by_time', -count, -1))
+
+
+def plays_between(redis, start, end):
+    # start and end are timestamps, either can be None for no limit
+    return load_plays(redis, redis.zrangebyscore(
+        'history:by_time',
+        '-inf' if start is None else start,
+        '+inf' if end is None else end,
+    ))
+
+
+def play_count(redis, id):
+    return redis.zcard(track_key(id))
+
+
+def last_played(redis, id):
+    # the start time of the track's most recent play, or None
+    last = redis.zrange(track_key(id), -1, -1, withscores=True)
+    if last:
+        return last[0][1]
+    return None
+
+
+def play_stats(redis):
+    # play counts and last played times, both by track ID
+    return [redis.hgetall(key) for key in PLAY_STATS_KEYS]
+
+
+def backfill_play_stats(redis):
+    # once, for histories kept before the play stats were (see
+    # backfill_play_stats in deck.redis.SCRIPTS)
+    redis.script('backfill_play_stats', [
+        'history', *PLAY_STATS_KEYS, 'history:play_stats_backfilled',
+    ])
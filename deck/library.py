@@ -0,0 +1,301 @@
+import click
+import ctypes
+import json
+from mimetypes import guess_type
+import os
+import struct
+import time
+from uuid import uuid4
+from deck import search, storage
+from deck.playlist import is_playlist
+from deck.tracks import file_identity, read_tracks, walk_directory
+
+
+# the library index: every audio file below the scanned directories,
+# by real path, with its identity and tags; alongside it the same paths
+# in a sorted set (all scored 0, so they sort by name) to find those
+# below a directory, and the scanned directories by when last scanned;
+# library:version changes with every change to the index, so copies of
+# it (see deck.smart) can tell when they are out of date
+BATCH_SIZE = 500
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (
+    IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+)
+EVENT = struct.Struct('iIII')
+
+known_roots = None
+
+
+def is_audio(path):
+    guessed_type = guess_type(path)[0]
+    return bool(
+        guessed_type
+        and guessed_type.startswith('audio/')
+        and not is_playlist(path)
+    )
+
+
+def roots(redis):
+    # read once per process, as they change far less often than they
+    # are asked about; a process started before a new directory was
+    # scanned just reads that directory from the disk as it always did
+    global known_roots
+    if known_roots is None:
+        known_roots = [root.decode() for root in redis.zrange('library:roots', 0, -1)]
+    return known_roots
+
+
+def indexed_root(redis, path):
+    for root in roots(redis):
+        if path == root or path.startswith(root + os.sep):
+            return root
+    return None
+
+
+def lookup(redis, files):
+    # tracks for those files that are in the index, by the path given;
+    # the index is by real path, so links and relative paths are
+    # resolved to look them up
+    paths = {file: os.path.realpath(file) for file in files}
+    candidates = [file for file in paths if indexed_root(redis, paths[file])]
+    if not candidates:
+        return {}
+    tracks = {}
+    for file, entry in zip(
+        candidates, redis.hmget('library', [paths[file] for file in candidates])
+    ):
+        if entry:
+            entry = json.loads(entry.decode())
+            tracks[file] = {
+                'id': entry['id'],
+                'file': paths[file],
+                'tags': entry['tags'],
+            }
+    return tracks
+
+
+def paths_below(redis, dir):
+    return [
+        path.decode()
+        for path in redis.zrangebylex(
+            'library:paths', '[' + dir + os.sep, '(' + dir + chr(ord(os.sep) + 1),
+        )
+    ]
+
+
+def indexed_files(redis, dir, reverse=False):
+    # the same as walk_directory, from the index rather than the disk,
+    # or None when the directory isn't in the library
+    dir = os.path.realpath(dir)
+    if not indexed_root(redis, dir):
+        return None
+    files = {}
+    subdirs = {}
+    for path in paths_below(redis, dir):
+        parent = os.path.dirname(path)
+        files.setdefault(parent, []).append(path)
+        while parent != dir and parent not in subdirs.get(os.path.dirname(parent), ()):
+            subdirs.setdefault(os.path.dirname(parent), set()).add(parent)
+            parent = os.path.dirname(parent)
+    return walk_index(dir, files, subdirs, reverse)
+
+
+def walk_index(dir, files, subdirs, reverse):
+    yield sorted(files.get(dir, []))
+    for subdir in sorted(subdirs.get(dir, ()), reverse=reverse):
+        yield from walk_index(subdir, files, subdirs, reverse)
+
+
+class Indexer:
+    # brings the index up to date for files, a batch at a time; only
+    # files that are new or whose identity changed are read again
+    def __init__(self, redis):
+        self.redis = redis
+        self.pending = []
+        self.read = 0
+        self.removed = 0
+
+    def add(self, path):
+        self.pending.append(path)
+        if len(self.pending) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        paths = []
+        identities = []
+        for path in self.pending:
+            try:
+                identities.append(file_identity(path))
+                paths.append(path)
+            except OSError:
+                self.forget([path])
+        self.pending = []
+        if not paths:
+            return
+        changed = []
+        unchanged = []
+        for path, identity, entry in zip(
+            paths, identities, self.redis.hmget('library', paths)
+        ):
+            entry = entry and json.loads(entry.decode())
+            if not entry or entry['identity'] != identity:
+                changed.append((path, identity))
+            else:
+                unchanged.append({'file': path, 'tags': entry['tags']})
+        # (the search index is checked for every file, so it catches up
+        # with files indexed before it was)
+        search.index_tracks(self.redis, unchanged)
+        if not changed:
+            return
+        tracks = read_tracks([path for path, identity in changed])
+        search.index_tracks(self.redis, tracks)
+        pipeline = self.redis.pipeline()
+        pipeline.hset_many('library', {
+            path: json.dumps({
+                'id': track['id'],
+                'identity': identity,
+                'tags': track['tags'],
+            })
+            for (path, identity), track in zip(changed, tracks)
+        })
+        pipeline.zadd('library:paths', {path: 0 for path, identity in changed})
+        pipeline.set('library:version', uuid4().hex)
+        pipeline.execute()
+        self.read += len(changed)
+
+    def forget(self, paths):
+        if paths:
+            pipeline = self.redis.pipeline()
+            pipeline.hdel('library', *paths)
+            pipeline.zrem('library:paths', *paths)
+            pipeline.set('library:version', uuid4().hex)
+            pipeline.execute()
+            search.unindex_files(self.redis, paths)
+            self.removed += len(paths)
+
+    def scan(self, dir):
+        # everything below a directory, dropping what has gone from it
+        indexed = set(paths_below(self.redis, dir))
+        for files in walk_directory(dir):
+            for path in files:
+                if is_audio(path):
+                    indexed.discard(path)
+                    self.add(path)
+        self.flush()
+        self.forget(sorted(indexed))
+
+
+def scan_roots(redis, paths):
+    indexer = Indexer(redis)
+    for path in paths:
+        root = os.path.realpath(path)
+        indexer.scan(root)
+        redis.zadd('library:roots', {root: time.time()})
+    return indexer
+
+
+class Watcher:
+    # keeps the index current as files below the roots change
+    def __init__(self, redis, roots):
+        self.redis = redis
+        self.roots = roots
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1')
+        self.dirs = {}
+        for root in roots:
+            self.watch_tree(root)
+
+    def watch_tree(self, dir):
+        self.watch(dir)
+        for root, dirs, files in os.walk(dir):
+            for subdir in dirs:
+                self.watch(os.path.join(root, subdir))
+
+    def watch(self, dir):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir), WATCH_MASK)
+        if wd >= 0:
+            self.dirs[wd] = dir
+
+    def events(self):
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            yield wd, mask, os.fsdecode(name)
+
+    def run(self):
+        while True:
+            indexer = Indexer(self.redis)
+            for wd, mask, name in self.events():
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost, so look at everything again
+                    for root in self.roots:
+                        indexer.scan(root)
+                    continue
+                dir = self.dirs.get(wd)
+                if mask & IN_IGNORED:
+                    self.dirs.pop(wd, None)
+                if not dir or not name:
+                    continue
+                path = os.path.join(dir, name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        self.watch_tree(path)
+                        indexer.scan(path)
+                    elif mask & (IN_DELETE | IN_MOVED_FROM):
+                        indexer.forget(paths_below(self.redis, path))
+                elif is_audio(path):
+                    if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                        indexer.add(path)
+                    elif mask & (IN_DELETE | IN_MOVED_FROM):
+                        indexer.forget([path])
+            indexer.flush()
+            if indexer.read or indexer.removed:
+                print('%d files read, %d removed' % (indexer.read, indexer.removed))
+
+
+@click.group()
+def library():
+    pass
+
+
+@library.command()
+@click.argument('paths', nargs=-1)
+def scan(paths):
+    # with no paths, the directories scanned before are scanned again
+    redis = storage.connect()
+    if not paths:
+        paths = roots(redis)
+    started = time.monotonic()
+    indexer = scan_roots(redis, paths)
+    print('%d files in the library, %d read, %d removed (%.2fs)' % (
+        redis.zcard('library:paths'),
+        indexer.read,
+        indexer.removed,
+        time.monotonic() - started,
+    ))
+
+
+@library.command()
+def watch():
+    redis = storage.connect()
+    # anything changed while nothing was watching
+    scan_roots(redis, roots(redis))
+    Watcher(redis, roots(redis)).run()
@@ -0,0 +1,118 @@
+import gi
+gi.require_version('Gst', '1.0')
+
+from gi.repository import Gst
+
+import click
+import json
+from multiprocessing import get_context
+import os
+from deck import storage
+from deck.tracks import file_identity, find_tracks
+
+
+def analyse_file(track):
+    # runs in a worker process, so needs its own GStreamer setup
+    Gst.init(None)
+    pipeline = Gst.parse_launch(
+        'filesrc name=source ! decodebin ! audioconvert ! audioresample'
+        ' ! rganalysis ! fakesink'
+    )
+    pipeline.get_by_name('source').set_property('location', track)
+    bus = pipeline.get_bus()
+    pipeline.set_state(Gst.State.PLAYING)
+    gain = None
+    peak = None
+    while True:
+        message = bus.timed_pop_filtered(
+            Gst.CLOCK_TIME_NONE,
+            Gst.MessageType.TAG | Gst.MessageType.EOS | Gst.MessageType.ERROR,
+        )
+        if message.type == Gst.MessageType.TAG:
+            # rganalysis tags the stream just before EOS, after
+            # any replaygain tags already in the file
+            tags = message.parse_tag()
+            found, value = tags.get_double(Gst.TAG_TRACK_GAIN)
+            if found:
+                gain = value
+            found, value = tags.get_double(Gst.TAG_TRACK_PEAK)
+            if found:
+                peak = value
+        elif message.type == Gst.MessageType.EOS:
+            break
+        else:
+            gain = None
+            break
+    pipeline.set_state(Gst.State.NULL)
+    return track, gain, peak
+
+
+def cached_loudness(redis, track):
+    cached = redis.hget('loudness', track)
+    if cached:
+        cached = json.loads(cached.decode())
+        try:
+            if cached['identity'] == file_identity(track):
+                return cached
+        except OSError:
+            pass
+    return None
+
+
+def tag_value(tags, name):
+    # tinytag versions differ on where they put the replaygain fields,
+    # and whether values are strings or lists of strings
+    for source in (tags, tags.get('extra') or {}, tags.get('other') or {}):
+        value = source.get(name)
+        if isinstance(value, list):
+            value = value[0] if value else None
+        if value:
+            try:
+                return float(str(value).lower().replace('db', '').strip())
+            except ValueError:
+                pass
+    return None
+
+
+def gain_factor(track, redis):
+    # the linear volume multiplier that brings the track to the
+    # replaygain reference level without clipping its peak
+    loudness = cached_loudness(redis, track['file'])
+    if loudness:
+        gain = loudness['gain']
+        peak = loudness['peak']
+    else:
+        gain = tag_value(track['tags'], 'replaygain_track_gain')
+        peak = tag_value(track['tags'], 'replaygain_track_peak')
+    if gain is None:
+        return 1
+    factor = 10 ** (gain / 20)
+    if peak:
+        factor = min(factor, 1 / peak)
+    return factor
+
+
+@click.command()
+@click.option('--jobs', default=os.cpu_count(), show_default=True)
+@click.argument('paths', nargs=-1)
+def analyse(jobs, paths):
+    redis = storage.connect()
+    todo = [
+        track
+        for track in find_tracks(paths)
+        if not cached_loudness(redis, track)
+    ]
+    print('%d tracks to analyse' % len(todo))
+    # forkserver, as read_tracks does: the deck CLI has the player (and
+    # so GStreamer and the GPIO library) loaded, which forking would copy
+    with get_context('forkserver').Pool(jobs) as pool:
+        for track, gain, peak in pool.imap_unordered(analyse_file, todo):
+            if gain is None:
+                print('** could not analyse "%s"' % track)
+                continue
+            redis.hset('loudness', track, json.dumps({
+                'identity': file_identity(track),
+                'gain': gain,
+                'peak': peak,
+            }))
+            print('%+6.2f dB  %s' % (gain, track))
@@ -0,0 +1,173 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+
+
+# in seconds, from a fraction of a redis round trip up to a slow track start
+BUCKETS = [
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+]
+
+registry = []
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def render(self):
+        return [
+            '# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s counter' % self.name,
+            '%s %s' % (self.name, self.value),
+        ]
+
+
+class Gauge(Counter):
+    def set(self, value):
+        self.value = value
+
+    def render(self):
+        return [
+            '# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s gauge' % self.name,
+            '%s %s' % (self.name, self.value),
+        ]
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+        self.started = None
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value):
+        with self.lock:
+            self.count += 1
+            self.sum += value
+            for index, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    self.counts[index] += 1
+
+    def begin(self):
+        # for latencies that start and end in different places
+        self.started = time.monotonic()
+
+    def end(self):
+        started = self.started
+        if started is not None:
+            self.started = None
+            self.observe(time.monotonic() - started)
+
+    def render(self):
+        with self.lock:
+            lines = [
+                '# HELP %s %s' % (self.name, self.help),
+                '# TYPE %s histogram' % self.name,
+            ]
+            for bucket, count in zip(self.buckets, self.counts):
+                lines.append('%s_bucket{le="%s"} %d' % (self.name, bucket, count))
+            lines.append('%s_bucket{le="+Inf"} %d' % (self.name, self.count))
+            lines.append('%s_sum %f' % (self.name, self.sum))
+            lines.append('%s_count %d' % (self.name, self.count))
+        return lines
+
+
+queue_to_audio = Histogram(
+    'deck_queue_to_audio_seconds',
+    'Time from popping a track off the queue to it playing.',
+)
+track_gap = Histogram(
+    'deck_track_gap_seconds',
+    'Silence between the expected end of one track and the start of the next.',
+)
+command_latency = Histogram(
+    'deck_command_latency_seconds',
+    'Time from a command being sent to the player acting on it.',
+)
+gstreamer_errors = Counter(
+    'deck_gstreamer_errors_total',
+    'Errors posted on the player pipeline bus.',
+)
+gstreamer_eos = Counter(
+    'deck_gstreamer_eos_total',
+    'Tracks that played through to the end of the stream.',
+)
+redis_commands = Histogram(
+    'deck_redis_command_seconds',
+    'Round trip time of non-blocking redis commands.',
+)
+scrobble_backlog = Gauge(
+    'deck_scrobble_backlog',
+    'Plays waiting to be scrobbled.',
+)
+scrobble_latency = Histogram(
+    'deck_scrobble_submit_seconds',
+    'Time taken to submit a scrobble or now playing update to Last.fm.',
+)
+tag_cache_hits = Counter(
+    'deck_tag_cache_hits_total',
+    'Tracks whose tags were found in the tag cache.',
+)
+tag_cache_misses = Counter(
+    'deck_tag_cache_misses_total',
+    'Tracks whose tags had to be read from the file.',
+)
+nfc_polls = Counter(
+    'deck_nfc_polls_total',
+    'Times the NFC reader was polled for a tag.',
+)
+nfc_errors = Counter(
+    'deck_nfc_errors_total',
+    'Errors reported by the PN532 NFC reader.',
+)
+nfc_tap_to_audio = Histogram(
+    'deck_nfc_tap_to_audio_seconds',
+    'Time from an NFC tag being seen to its playlist playing.',
+)
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, address='127.0.0.1'):
+    # only on this machine, unless told otherwise
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
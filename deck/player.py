@@ -9,61 +9,226 @@ from datetime import datetime, timedelta
 import httpcore
 import itertools
 import json
-from mimetypes import guess_type
 import os
 from lib.pn532 import *
 import pylast
+import queue as local_queue
 import RPi.GPIO as GPIO
 from select import select
 import sys
 import termios
 import threading
 import time
-from tinytag import TinyTag
 import tty
-from deck.redis import Redis
+from deck import control, history, metrics, playqueue, renderer, search, storage
+from deck.control import ACK_TIMEOUT, command_request, send_command
+from deck.enqueue import enqueue, insert_after, queue_entries, replace_queue_entries
+from deck.loudness import gain_factor
+from deck.playlist import is_playlist, read_playlist
+from deck.tagcache import cached_track, cached_tracks, complete_track
+from deck.storage import STREAM_LENGTH
+from deck.tracks import (
+    intern_track,
+    load_track,
+    load_tracks,
+    migrate_track_entries,
+    parse_track,
+    track_id,
+    track_record,
+)
+
+
+# the scrobbler's consumer group, and its only consumer
+SCROBBLE_GROUP = 'scrobbler'
+
+# seconds after which a now playing update is no longer worth sending
+NOW_PLAYING_EXPIRY = 600
+
+# where the playlist for each NFC tag is, as <uid>.m3u
+NFC_DIR = os.environ.get('DECK_NFC_DIR', 'nfc')
+
+# errors from a pipeline that mean the audio device is the problem,
+# rather than the track it was given
+DEVICE_ERRORS = [
+    Gst.ResourceError.BUSY,
+    Gst.ResourceError.OPEN_WRITE,
+    Gst.ResourceError.OPEN_READ_WRITE,
+]
 
 
 class PlayerErrors:
     def error(self, text):
-        width = os.get_terminal_size()[0]
-        print('\r**', text.ljust(width - 1), end='\r\n')
+        renderer.shared().text('** ' + text)
+
+
+class SeekScheduler:
+    # key auto-repeat can ask for seeks far faster than they complete,
+    # so requests are merged into one target and only one flushing
+    # seek is in flight at a time
+
+    # formats where seeking to the exact sample is cheap; everything
+    # else seeks to the nearest keyframe for responsiveness
+    ACCURATE_FORMATS = ['.aif', '.aiff', '.flac', '.wav']
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self, file=''):
+        self.relative = 0
+        self.absolute = None
+        self.in_flight = None
+        self.direction = None
+        self.shown_until = 0
+        self.flags = Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT
+        if os.path.splitext(file)[1].lower() in self.ACCURATE_FORMATS:
+            self.flags = Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE
+
+    def seek_by(self, seconds, show_state=True):
+        self.relative += seconds
+        if show_state:
+            self.direction = 'seek_forwards'
+            if seconds < 0:
+                self.direction = 'seek_backwards'
+            # long enough for the seek indicator to be seen
+            self.shown_until = time.monotonic() + 0.2
+
+    def seek_to(self, fraction):
+        self.absolute = fraction
+        self.relative = 0
+
+    def showing(self):
+        if time.monotonic() < self.shown_until:
+            return self.direction
+        return None
+
+    def done(self):
+        self.in_flight = None
+
+    def service(self, pipeline):
+        if self.in_flight:
+            # don't wait forever for an ASYNC_DONE that isn't coming
+            if time.monotonic() - self.in_flight < 1:
+                return
+            self.in_flight = None
+        if not self.relative and self.absolute is None:
+            return
+
+        duration = pipeline.query_duration(Gst.Format.TIME)[1]
+        if duration < 0:
+            # not prerolled yet, try again next time
+            return
+        if self.absolute is not None:
+            seek = duration * self.absolute
+        else:
+            seek = pipeline.query_position(Gst.Format.TIME)[1]
+        seek = seek + (self.relative * 1000000000)
+        self.relative = 0
+        self.absolute = None
+
+        if pipeline.seek_simple(
+            Gst.Format.TIME,
+            self.flags,
+            min(max(seek, 0), duration),
+        ):
+            self.in_flight = time.monotonic()
 
 
 class Player(PlayerErrors):
-    def __init__(self, loop):
-        self.player = Gst.ElementFactory.make('playbin', 'player')
-        self.bus = self.player.get_bus()
-        self.bus.add_signal_watch()
-        self.bus.connect('message', self.on_message)
+    def __init__(self, loop, gapless=False, fps=5, headless=False):
+        self.gapless = gapless
+        self.player = self.make_pipeline('player')
+        # a second pipeline kept prerolled on the head of the queue,
+        # so moving on to it is only a swap and a state change
+        self.standby = self.make_pipeline('standby')
+        self.standby_track = None
+        self.standby_stale = True
+        # a track the standby couldn't preroll, left to start from cold
+        self.standby_failed = None
+        # replaygain adjustments, applied through playbin's own volume
+        self.gain = 1
+        self.standby_gain = 1
+        self.seeks = SeekScheduler()
         self.state = Gst.State.NULL
         self.loop = loop
-        self.redis = Redis()
+        self.renderer = renderer.shared()
+        self.renderer.set_fps(fps)
+        self.renderer.headless = headless
+        self.headless = headless
+        self.current_track = None
+        self.spinning = False
+        self.stored_state = 'null'
+        self.gapless_track = None
+        self.handoff = None
+        self.track_end_estimate = None
+        self.listened = 0
+        self.listening_since = None
+        self.cut_short = False
+        self.redis = storage.connect()
+        self.commands = local_queue.Queue()
+        self.wake_reader, self.wake_writer = os.pipe()
+        self.queue_changed = True
+        # commands sent while no player was running are stale
+        self.redis.delete('commands')
+        threading.Thread(target=self.listen_for_commands, daemon=True).start()
+        migrate_track_entries(self.redis)
+        history.backfill_play_stats(self.redis)
         self.restore_state()
         self.spinner = itertools.cycle(['⠇', '⠏', '⠋', '⠙', '⠹', '⠸', '⠼', '⠴', '⠦', '⠧'])
-        self.original_terminal_state = termios.tcgetattr(sys.stdin.fileno())
-        tty.setraw(sys.stdin.fileno())
+        if not headless:
+            self.original_terminal_state = termios.tcgetattr(sys.stdin.fileno())
+            tty.setraw(sys.stdin.fileno())
+
+    def make_pipeline(self, name):
+        pipeline = Gst.ElementFactory.make('playbin', name)
+        sink = os.environ.get('DECK_AUDIO_SINK')
+        if sink:
+            # eg. "fakesink sync=true" to play without a sound card
+            pipeline.set_property('audio-sink', Gst.parse_launch(sink))
+        bus = pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect('message', self.on_message, pipeline)
+        if self.gapless:
+            pipeline.connect('about-to-finish', self.on_about_to_finish)
+        return pipeline
+
+    def on_message(self, bus, message, pipeline):
+        if pipeline is not self.player:
+            if message.type == Gst.MessageType.ERROR:
+                self.standby_error(message, pipeline)
+            return
 
-    def on_message(self, bus, message):
         if message.type == Gst.MessageType.STATE_CHANGED:
             state = message.parse_state_changed()[1]
             if state != self.state:
                 self.state = state
+            if message.src == pipeline and state == Gst.State.PLAYING:
+                metrics.queue_to_audio.end()
+                metrics.nfc_tap_to_audio.end()
         elif message.type == Gst.MessageType.EOS:
+            metrics.gstreamer_eos.inc()
             self.player_state(Gst.State.NULL)
             self.playing = False
         elif message.type == Gst.MessageType.ERROR:
+            metrics.gstreamer_errors.inc()
             self.player_state(Gst.State.NULL)
             err, debug = message.parse_error()
             self.error('error "%s" "%s"' % (err, debug))
             self.playing = False
+        elif message.type == Gst.MessageType.ASYNC_DONE:
+            self.seeks.done()
+        elif message.type == Gst.MessageType.STREAM_START:
+            self.record_gap()
+            if self.gapless_track:
+                # the pre-queued track is now audible, so end the
+                # current one and let spin do the history bookkeeping
+                self.handoff = self.gapless_track
+                self.gapless_track = None
+                self.playing = False
         elif message.type in [
-            Gst.MessageType.ASYNC_DONE,
             Gst.MessageType.DURATION_CHANGED,
             Gst.MessageType.LATENCY,
             Gst.MessageType.NEW_CLOCK,
             Gst.MessageType.RESET_TIME,
-            Gst.MessageType.STREAM_START,
             Gst.MessageType.STREAM_STATUS,
             Gst.MessageType.TAG,
         ]:
@@ -71,30 +236,135 @@ class Player(PlayerErrors):
         else:
             self.error('unknown message type "%s"' % message.type)
 
+    def standby_error(self, message, pipeline):
+        err, debug = message.parse_error()
+        pipeline.set_state(Gst.State.NULL)
+        device = (
+            isinstance(message.src, Gst.Element)
+            and message.src.has_flag(Gst.ElementFlags.SINK)
+        ) or any(
+            err.matches(Gst.ResourceError.quark(), code)
+            for code in DEVICE_ERRORS
+        )
+        if device:
+            # can't preroll at all (eg. the audio device can't be
+            # opened twice), so tracks start from cold as they used to
+            self.error('standby disabled "%s"' % err)
+            self.standby = None
+        elif self.standby_track:
+            # just this track (eg. one that can't be decoded), which
+            # will fail again when played; the next head is prerolled
+            # as usual
+            self.standby_failed = self.standby_track['id']
+        self.standby_track = None
+
+    def on_about_to_finish(self, playbin):
+        # called from the streaming thread shortly before the current
+        # track runs out; setting the uri now lets playbin move on to
+        # the next track without tearing the pipeline down
+        if playbin is not self.player or self.state != Gst.State.PLAYING:
+            return
+        self.standby_stale = True
+        redis = storage.connect()
+        while True:
+            popped = playqueue.pop(redis)
+            if not popped:
+                return
+            track = parse_track(*popped)
+            if track and os.path.isfile(track['file']):
+                break
+            self.error('missing track "%s"' % popped[0].decode())
+        self.gapless_track = track
+        playbin.set_property('uri', 'file://' + track['file'])
+
+    def requeue_gapless_track(self):
+        # a pre-queued track that never started goes back on the queue
+        if self.gapless_track:
+            playqueue.push(self.redis, [self.gapless_track['id']], head=True)
+            self.gapless_track = None
+
+    def preroll_standby(self):
+        self.standby_stale = False
+        if not self.standby:
+            return
+        id = playqueue.peek(self.redis)
+        if self.standby_track and self.standby_track['id'] == id:
+            return
+        if not id and not self.standby_track:
+            return
+        track = None
+        if id:
+            track = load_track(self.redis, id)
+        self.standby.set_state(Gst.State.NULL)
+        self.standby_track = None
+        if track and track['id'] == self.standby_failed:
+            return
+        if track and os.path.isfile(track['file']):
+            track = complete_track(self.redis, track)
+            self.standby_gain = gain_factor(track, self.redis)
+            self.standby.set_property('uri', 'file://' + track['file'])
+            self.standby.set_property('volume', self.volume / 1000 * self.standby_gain)
+            self.standby.set_property('mute', self.player.get_property('mute'))
+            self.standby.set_state(Gst.State.PAUSED)
+            self.standby_track = track
+
+    def swap_to_standby(self, track):
+        # use the prerolled pipeline if it is on the track wanted,
+        # otherwise fall back to starting the track from cold
+        if not self.standby or not self.standby_track:
+            return False
+        if track['id'] != self.standby_track['id']:
+            return False
+        self.player.set_state(Gst.State.NULL)
+        self.player, self.standby = self.standby, self.player
+        self.gain = self.standby_gain
+        self.standby_track = None
+        self.standby_stale = True
+        return True
+
+    def record_gap(self):
+        if self.track_end_estimate:
+            gap = time.monotonic() - self.track_end_estimate
+            metrics.track_gap.observe(max(gap, 0))
+            self.redis.set('last_gap', '%.6f' % gap)
+        self.track_end_estimate = None
+
     def play(self, file):
-        track = os.path.realpath(file)
-        tags = TinyTag.get(track)
-        self.play_track({'file': track, 'tags': tags.as_dict()})
+        track = cached_track(self.redis, file)
+        intern_track(self.redis, track)
+        self.play_track(track)
         self.quit()
 
     def spin(self):
-        self.print_controls()
+        self.spinning = True
+        if not self.headless:
+            self.print_controls()
         while True:
             if self.state == 'stopped':
                 char = self.wait_for_key(timeout=0.2)
                 if char and ord(char) == 32:
                     self.player_state(Gst.State.NULL)
             else:
-                track = self.redis.lindex('queue', 0)
+                continuing = self.handoff is not None
+                if continuing:
+                    track = self.handoff
+                    self.handoff = None
+                elif self.queue_changed:
+                    # only look at the queue when told it changed, so an
+                    # idle player makes no redis calls at all
+                    track = None
+                    popped = playqueue.pop(self.redis)
+                    if popped:
+                        metrics.queue_to_audio.begin()
+                        track = parse_track(*popped)
+                        if not track:
+                            self.error('unknown track "%s"' % popped[0].decode())
+                    else:
+                        self.queue_changed = False
+                else:
+                    track = None
                 if track:
-                    track = track.decode()
-                    self.redis.lpop('queue')
-                    self.play_track(json.loads(track))
-                    if self.get_state() == 'stopped':
-                        self.redis.lpush('queue', track)
-                    elif self.get_state() not in ['skipped', 'previous']:
-                        self.redis.lpush('recently_played', track)
-                        self.redis.ltrim('recently_played', 0, 99)
+                    self.play_track(track, continuing=continuing)
                 else:
                     char = self.wait_for_key(timeout=0.2)
                     if char:
@@ -110,20 +380,53 @@ class Player(PlayerErrors):
             self.output_player_state()
 
     def print_controls(self):
-        print('[Space]:pause/play  [L]:fast-fwd    [J]:rewind      [1..0]:position', end='\r\n')
-        print('[Q/+]:vol up        [A/-]:vol down  [M]:mute        [!..)]:volume', end='\r\n')
-        print('[N]:next track      [P]:prev track  [X]:skip track  [S]:stop         [V]:vacate', end='\r\n')
-        print('[^C]:quit player', end='\r\n\n')
-
-    def play_track(self, track):
+        self.renderer.lines([
+            '[Space]:pause/play  [L]:fast-fwd    [J]:rewind      [1..0]:position',
+            '[Q/+]:vol up        [A/-]:vol down  [M]:mute        [!..)]:volume',
+            '[N]:next track      [P]:prev track  [X]:skip track  [S]:stop         [V]:vacate',
+            '[^C]:quit player',
+            '',
+        ])
+
+    def play_track(self, track, continuing=False):
         if os.path.isfile(track['file']):
-            self.redis.set('current_track', json.dumps(track))
+            track = complete_track(self.redis, track)
+            self.current_track = track
+            self.seeks.reset(track['file'])
+            pipeline = self.redis.pipeline()
+            pipeline.set('current_track', track['id'])
+            pipeline.xadd(
+                'scrobbles',
+                {'type': 'now_playing', 'id': track['id']},
+                STREAM_LENGTH,
+            )
+            pipeline.execute()
             self.output_text_state(format_track_text(track, flag='-'))
-            self.player.set_property('uri', 'file://' + track['file'])
-            self.player_state(Gst.State.PLAYING)
+            if continuing:
+                # a gapless handoff is already playing this track
+                self.gain = gain_factor(track, self.redis)
+                self.apply_gain()
+            elif self.swap_to_standby(track):
+                self.player_state(Gst.State.PLAYING)
+                # already prerolled, so there is no STREAM_START
+                # to measure the gap at
+                self.record_gap()
+            else:
+                self.gain = gain_factor(track, self.redis)
+                self.apply_gain()
+                self.player.set_property('uri', 'file://' + track['file'])
+                self.player_state(Gst.State.PLAYING)
             started = datetime.now().timestamp()
+            # anything heard before now was the previous track
+            self.listened = 0
+            self.listening_since = None
+            self.listening(self.state == Gst.State.PLAYING)
+            self.cut_short = False
             self.playing = True
+            self.standby_stale = True
             while self.playing:
+                if self.standby_stale:
+                    self.preroll_standby()
                 # check for keypress with 1/10th of a second timeout
                 # so the progress bar gets refreshed regularly
                 char = self.wait_for_key(timeout=0.1)
@@ -132,7 +435,7 @@ class Player(PlayerErrors):
                         self.quit()
                     elif ord(char) == 32:
                         self.pause_or_resume()
-                        self.redis.set('current_track', json.dumps(track))
+                        self.redis.set('current_track', track['id'])
                     elif char in ['j', 'J']:
                         self.relative_seek(-15)
                     elif char in ['l', 'L']:
@@ -176,20 +479,25 @@ class Player(PlayerErrors):
                     elif char == ')':
                         self.set_volume(1000)
                     elif ord(char) == 12:
-                        os.system('clear')
+                        self.renderer.clear()
                         self.print_controls()
                         self.output_text_state(format_track_text(track, flag='-'))
                 self.check_for_command()
+                self.seeks.service(self.player)
                 self.output_player_state()
-            self.redis.delete('current_track')
-            if self.get_state() != 'skipped':
-                self.scrobble(track, started)
+            self.current_track = None
+            self.finish_track(track, started)
         else:
             self.output_text_state('** missing file "%s"' % track)
 
     def wait_for_key(self, timeout=1):
+        # also wakes early when a command arrives, so commands
+        # don't have to wait for the next tick to be acted on
         char = None
-        ready, _, _ = select([sys.stdin], [], [], timeout)
+        streams = [self.wake_reader]
+        if not self.headless:
+            streams.append(sys.stdin)
+        ready, _, _ = select(streams, [], [], timeout)
         for stream in ready:
             if stream == sys.stdin:
                 try:
@@ -197,60 +505,137 @@ class Player(PlayerErrors):
                 except UnicodeDecodeError:
                     # cheat to save working out how to do this properly for now
                     char = '£'
+            elif stream == self.wake_reader:
+                os.read(self.wake_reader, 1024)
         return char
 
+    def listen_for_commands(self):
+        # blocks on the command list in its own thread, handing each
+        # command to the player loop in the order they were sent
+        redis = storage.connect()
+        while True:
+            request = redis.blpop('commands')
+            if request:
+                self.submit(json.loads(request.decode()))
+
+    def submit(self, request):
+        self.commands.put(request)
+        os.write(self.wake_writer, b'.')
+
+    def control(self, message):
+        # requests from the control socket; status is answered straight
+        # away, commands once the player loop has acted on them
+        if message['command'] == 'status':
+            return {'ok': True, **self.status()}
+        request = {
+            'command': message['command'],
+            'sent': message.get('sent', time.time()),
+            'done': threading.Event(),
+        }
+        self.submit(request)
+        if request['done'].wait(ACK_TIMEOUT):
+            return {'ok': True}
+        return {'ok': False, 'error': 'timed out'}
+
+    def status(self):
+        return {
+            'state': self.stored_state,
+            'track': self.current_track,
+            'volume': self.volume,
+            'muted': self.player.get_property('mute'),
+        }
+
     def check_for_command(self):
-        command = self.redis.getdel('command')
-        if command:
-            if command.decode() == 'pause':
-                self.pause_or_resume()
-            elif command.decode() == 'next':
-                self.next_track()
-            elif command.decode() == 'previous':
-                self.previous_track()
-            elif command.decode() == 'stop':
-                self.stop()
-            elif command.decode() == 'skip':
-                self.skip()
-            elif command.decode() == 'quit':
-                self.quit()
-            else:
-                self.error('unknown command "%s" received' % command)
+        while True:
+            try:
+                request = self.commands.get_nowait()
+            except local_queue.Empty:
+                return
+            self.handle_command(request)
+
+    def handle_command(self, request):
+        command = request['command']
+        if 'sent' in request:
+            metrics.command_latency.observe(time.time() - request['sent'])
+        # any command can follow a change to the queue (eg. interrupt)
+        self.queue_changed = True
+        self.standby_stale = True
+        if command == 'pause':
+            self.pause_or_resume()
+        elif command == 'next':
+            self.next_track()
+        elif command == 'previous':
+            self.previous_track()
+        elif command == 'stop':
+            self.stop()
+        elif command == 'skip':
+            # interrupt and NFC tags replace the head of the queue and
+            # then skip to it, so the standby is moved onto the new head
+            # first, for the skip to swap to rather than start from cold
+            self.preroll_standby()
+            self.skip()
+        elif command == 'quit':
+            self.acknowledge(request)
+            self.quit()
+        elif command == 'queued':
+            pass
+        else:
+            self.error('unknown command "%s" received' % command)
+        self.acknowledge(request)
+
+    def acknowledge(self, request):
+        if 'done' in request:
+            request['done'].set()
+        elif request.get('wait'):
+            ack = 'ack:%s' % request['id']
+            self.redis.rpush(ack, 'ok')
+            self.redis.expire(ack, ACK_TIMEOUT)
 
     def pause_or_resume(self):
-        if self.state in [Gst.State.PLAYING, 'seek_forwards', 'seek_backwards']:
+        if self.state == Gst.State.PLAYING:
             self.player_state(Gst.State.PAUSED)
             self.relative_seek(-0.05, show_state=False)
         elif self.state in [Gst.State.PAUSED, 'stopped']:
             self.player_state(Gst.State.PLAYING)
-        time.sleep(0.1)
 
     def stop(self):
+        self.requeue_gapless_track()
+        self.cut_short = True
+        self.track_end_estimate = None
         self.redis.delete('current_track')
         self.player_state(Gst.State.NULL, 'stopped')
         self.playing = False
 
     def skip(self):
+        self.requeue_gapless_track()
+        self.cut_short = True
+        self.track_end_estimate = None
         self.redis.delete('current_track')
         self.player_state(Gst.State.NULL, 'skipped')
         self.playing = False
 
     def next_track(self):
+        self.requeue_gapless_track()
+        self.cut_short = True
+        self.track_end_estimate = None
         self.redis.delete('current_track')
         self.player_state(Gst.State.PAUSED)
         self.player_state(Gst.State.NULL)
         self.playing = False
 
     def previous_track(self):
+        self.requeue_gapless_track()
+        self.cut_short = True
+        self.track_end_estimate = None
         self.redis.delete('current_track')
-        track = self.redis.lpop('recently_played')
-        self.redis.lpush('queue', track)
+        self.redis.script('previous', ['recently_played', *playqueue.QUEUE_KEYS])
         self.player_state(Gst.State.PAUSED)
         self.player_state(Gst.State.NULL, 'previous')
         self.playing = False
 
     def clear_queue(self):
-        self.redis.ltrim('queue', 1, 0)
+        self.gapless_track = None
+        playqueue.clear(self.redis)
         self.skip()
 
     def player_state(self, state, store=None):
@@ -267,57 +652,36 @@ class Player(PlayerErrors):
                 self.error('unknown state "%s" to store' % state)
         else:
             self.state = store
+        self.stored_state = store
+        self.listening(self.state == Gst.State.PLAYING)
         self.redis.set('state', store)
 
-    def get_state(self):
-        state = self.redis.get('state')
-        if state:
-            return state.decode()
-        return None
-
     def relative_seek(self, amount=0, show_state=True):
-        position = self.player.query_position(Gst.Format.TIME)[1]
-        duration = self.player.query_duration(Gst.Format.TIME)[1]
-        seek = position + (amount * 1000000000)
-
+        self.seeks.seek_by(amount, show_state)
         if show_state:
-            self.state = 'seek_forwards'
-            if amount < 0:
-                self.state = 'seek_backwards'
-            self.output_player_state()
-
-        self.player.seek_simple(
-            Gst.Format.TIME,
-            Gst.SeekFlags.FLUSH,
-            min(max(seek, 0), duration),
-        )
-
-        if show_state:
-            # allow a small amount of time for the seek
-            # indicator to remain on screen
-            time.sleep(0.2)
+            self.output_player_state(force=True)
 
     def set_position(self, position):
         position = int(position) - 1
         if position < 0:
             position = 9
-        duration = self.player.query_duration(Gst.Format.TIME)[1]
-        seek = 0 + (duration * (position / 10))
-        self.player.seek_simple(
-            Gst.Format.TIME,
-            Gst.SeekFlags.FLUSH,
-            min(max(seek, 0), duration),
-        )
-        time.sleep(0.1)
+        self.seeks.seek_to(position / 10)
 
     def adjust_volume(self, adjustment):
-        volume = (self.player.get_property('volume') * 1000) + adjustment
+        volume = self.volume + adjustment
         self.set_volume(volume)
 
+    def apply_gain(self):
+        # for a new track; the volume (and whether muted) stays as it was
+        self.player.set_property('volume', self.volume / 1000 * self.gain)
+
     def set_volume(self, volume):
         volume = min(max(int(volume), 0), 1000)
+        self.volume = volume
         actual = volume / 1000
-        self.player.set_property('volume', actual)
+        self.player.set_property('volume', actual * self.gain)
+        if self.standby:
+            self.standby.set_property('volume', actual * self.standby_gain)
         self.redis.set('volume', volume)
         self.unmute()
 
@@ -329,19 +693,28 @@ class Player(PlayerErrors):
 
     def mute(self):
         self.player.set_property('mute', True)
+        if self.standby:
+            self.standby.set_property('mute', True)
         self.redis.set('muted', 1)
 
     def unmute(self):
         self.player.set_property('mute', False)
+        if self.standby:
+            self.standby.set_property('mute', False)
         self.redis.set('muted', 0)
 
     def output_text_state(self, text):
-        print(text.ljust(79), end='\r\n', flush=True)
+        self.renderer.text(text)
+
+    def output_player_state(self, force=False):
+        # the key-polling loop runs faster than the status line needs
+        # to be redrawn, so skip the work entirely between frames
+        if not force and not self.renderer.frame_due():
+            return
 
-    def output_player_state(self):
         progress_bar_width = 44
-        if os.get_terminal_size()[0] > 80:
-            progress_bar_width = os.get_terminal_size()[0] - 36
+        if self.renderer.width > 80:
+            progress_bar_width = self.renderer.width - 36
 
         duration = self.player.query_duration(Gst.Format.TIME)[1]
         position = self.player.query_position(Gst.Format.TIME)[1]
@@ -355,22 +728,29 @@ class Player(PlayerErrors):
             progress_bar = (('_' * (progress-1)) + 'V').ljust(progress_bar_width, '_')
             position_time = self.minutes_seconds(position)
             duration_time = self.minutes_seconds(duration)
+            if self.state == Gst.State.PLAYING:
+                # when the track should run out, used to measure the
+                # gap before the next one starts
+                self.track_end_estimate = (
+                    time.monotonic() + (duration - position) / 1000000000
+                )
 
         volume_bar_width = 10
-        volume = int(round(self.player.get_property('volume'), 1) * 10)
+        volume = int(round(self.volume / 1000, 1) * 10)
         volume_bar = ('=' * volume).ljust(volume_bar_width)
 
         if self.player.get_property('mute'):
             volume_bar = volume_bar[0:3] + ' XX ' + volume_bar[7:10]
 
-        if self.state == Gst.State.PLAYING:
+        seeking = self.seeks.showing()
+        if seeking == 'seek_forwards':
+            state = '→'
+        elif seeking == 'seek_backwards':
+            state = '←'
+        elif self.state == Gst.State.PLAYING:
             state = '▶'
         elif self.state == Gst.State.PAUSED:
             state = '‖'
-        elif self.state == 'seek_forwards':
-            state = '→'
-        elif self.state == 'seek_backwards':
-            state = '←'
         elif self.state == 'stopped':
             state = '◼'
         elif self.state in [Gst.State.NULL, 'skipped']:
@@ -380,15 +760,48 @@ class Player(PlayerErrors):
 
         # 12345678901234567890123456789012345678901234567890123456789012345678901234567890
         #   ▶  [==========]   00:04 [______|_____________________________________] 00:31
-        print(
-            f"  {state}  [{volume_bar}]   {position_time} [{progress_bar}] {duration_time}",
-            end='\r',
-            flush=True,
+        self.renderer.status(
+            f"  {state}  [{volume_bar}]   {position_time} [{progress_bar}] {duration_time}"
+        )
+
+    def finish_track(self, track, started):
+        # all the bookkeeping at the end of a track, in one round trip
+        state = self.stored_state
+        requeue = self.spinning and state == 'stopped'
+        recent = self.spinning and state not in ['stopped', 'skipped', 'previous']
+        scrobble = ''
+        if state != 'skipped':
+            scrobble = started
+        listened = self.listened
+        if self.listening_since is not None:
+            listened += time.monotonic() - self.listening_since
+        self.redis.script(
+            'finish_track',
+            [
+                'current_track',
+                *playqueue.QUEUE_KEYS,
+                'recently_played',
+                'scrobbles',
+                *history.history_keys(track['id']),
+            ],
+            [
+                track['id'],
+                int(requeue),
+                int(recent),
+                scrobble,
+                STREAM_LENGTH,
+                history.history_entry(track, started, listened, self.cut_short),
+                started,
+            ],
         )
 
-    def scrobble(self, track, started):
-        track['started'] = started
-        self.redis.rpush('scrobble_queue', json.dumps(track))
+    def listening(self, playing):
+        # how long the current track has actually been heard for,
+        # leaving out time paused or stopped
+        now = time.monotonic()
+        if self.listening_since is not None:
+            self.listened += now - self.listening_since
+        self.listening_since = now if playing else None
 
     def restore_state(self):
         volume = self.redis.get('volume')
@@ -404,7 +817,7 @@ class Player(PlayerErrors):
                 self.unmute()
         was_playing = self.redis.get('current_track')
         if was_playing:
-            self.redis.lpush('queue', was_playing.decode())
+            playqueue.push(self.redis, [was_playing.decode()], head=True)
 
     def minutes_seconds(self, t):
         s,ns = divmod(t, 1000000000)
@@ -412,19 +825,20 @@ class Player(PlayerErrors):
         return "%02i:%02i" % (m,s)
 
     def quit(self):
-        termios.tcsetattr(
-            sys.stdin.fileno(),
-            termios.TCSANOW,
-            self.original_terminal_state,
-        )
-        print()
+        if not self.headless:
+            termios.tcsetattr(
+                sys.stdin.fileno(),
+                termios.TCSANOW,
+                self.original_terminal_state,
+            )
+            print()
         self.loop.quit()
         sys.exit()
 
 
 class Scrobbler(PlayerErrors):
     def scrobble_plays(self):
-        redis = Redis()
+        redis = storage.connect()
         try:
             self.lastfm = pylast.LastFMNetwork(
                 api_key = os.environ['LASTFM_KEY'],
@@ -437,31 +851,57 @@ class Scrobbler(PlayerErrors):
             self.lastfm = None
 
         if self.lastfm:
-            current_track = None
+            redis.xgroup_create('scrobbles', SCROBBLE_GROUP)
             while True:
-                current = redis.get('current_track')
-                if current:
-                    track = json.loads(current.decode())
-                    if track != current_track:
-                        current_track = track
-                        self.scrobble_current(track)
-                scrobble = redis.lindex('scrobble_queue', 0)
-                if scrobble:
-                    track = json.loads(scrobble)
-                    self.scrobble_played(track)
-                    redis.lpop('scrobble_queue')
-                time.sleep(1)
+                # anything delivered but never acknowledged (because of a
+                # crash, or Last.fm being unreachable) is retried first
+                entries = redis.xreadgroup(
+                    'scrobbles', SCROBBLE_GROUP, SCROBBLE_GROUP, '0', count=10,
+                )
+                if not entries:
+                    entries = redis.xreadgroup(
+                        'scrobbles', SCROBBLE_GROUP, SCROBBLE_GROUP, '>',
+                        count=10, block=0,
+                    )
+                for entry, fields in entries:
+                    if not self.submit(redis, entry, fields):
+                        # leave it pending and try again later
+                        time.sleep(30)
+                        break
+                    redis.xack('scrobbles', SCROBBLE_GROUP, entry)
+                metrics.scrobble_backlog.set(
+                    redis.xgroup_backlog('scrobbles', SCROBBLE_GROUP)
+                )
+
+    def submit(self, redis, entry, fields):
+        if not fields:
+            # trimmed from the stream before it was ever scrobbled
+            return True
+        track = load_track(redis, fields[b'id'])
+        if not track:
+            return True
+        if fields[b'type'] == b'now_playing':
+            # now playing updates are only worth sending while they
+            # could still be true
+            added = int(entry.split(b'-')[0]) / 1000
+            if time.time() - added > NOW_PLAYING_EXPIRY:
+                return True
+            return self.scrobble_current(track)
+        track['started'] = float(fields[b'started'])
+        return self.scrobble_played(track)
 
     def scrobble_current(self, track):
         attempts = 3
         while attempts:
             try:
+                started = time.monotonic()
                 self.lastfm.update_now_playing(
                     album = track['tags']['album'],
                     artist = track['tags']['artist'],
                     title = track['tags']['title'],
                 )
-                attempts = 0
+                metrics.scrobble_latency.observe(time.monotonic() - started)
+                return True
             except httpcore.ConnectError as e:
                 if e.errno == -3:
                     # temp failure, retry
@@ -469,11 +909,13 @@ class Scrobbler(PlayerErrors):
                     attempts = attempts - 1
                 else:
                     raise
+        return False
 
     def scrobble_played(self, track):
         attempts = 3
         while attempts:
             try:
+                started = time.monotonic()
                 self.lastfm.scrobble(
                     album = track['tags']['album'],
                     artist = track['tags']['artist'],
@@ -481,7 +923,8 @@ class Scrobbler(PlayerErrors):
                     # FIXME mbid if known
                     timestamp = track['started'],
                 )
-                attempts = 0
+                metrics.scrobble_latency.observe(time.monotonic() - started)
+                return True
             except httpcore.ConnectError as e:
                 # FIXME account for other network failures
                 if e.errno == -3:
@@ -490,6 +933,76 @@ class Scrobbler(PlayerErrors):
                     attempts = attempts - 1
                 else:
                     raise
+        return False
+
+
+class NFCPlaylists:
+    # the queue each NFC tag plays (from <uid>.m3u in the directory),
+    # compiled ahead of time into ready to send track entries, so a tap
+    # costs a stat per file and one round trip; a playlist is compiled
+    # again when it or any file it lists changes, and tags without one
+    # are remembered until the directory changes
+    def __init__(self, dir):
+        self.dir = os.path.abspath(dir)
+        self.compiled = {}
+        self.unknown = set()
+        self.dir_changed = None
+        try:
+            names = os.listdir(self.dir)
+        except OSError:
+            names = []
+        for name in names:
+            if name.endswith('.m3u'):
+                self.entries(name[:-len('.m3u')])
+
+    def modified(self, path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def dependencies(self, playlist):
+        # the playlist and the files it lists, or None when it lists
+        # directories or other playlists, whose contents can change
+        # without their mtimes saying so; those are read on every tap
+        try:
+            paths = [entry for entry, tags in read_playlist(playlist)]
+        except OSError:
+            return None
+        if any(is_playlist(path) or os.path.isdir(path) for path in paths):
+            return None
+        return [playlist, *paths]
+
+    def entries(self, uid):
+        # None for a tag with no playlist
+        if uid in self.unknown:
+            if self.modified(self.dir) == self.dir_changed:
+                return None
+            self.unknown.clear()
+        # looked at before the playlist, so one added in between isn't
+        # missed next time
+        dir_changed = self.modified(self.dir)
+        playlist = os.path.join(self.dir, uid + '.m3u')
+        if self.modified(playlist) is None:
+            self.compiled.pop(uid, None)
+            self.unknown.add(uid)
+            self.dir_changed = dir_changed
+            return None
+        compiled = self.compiled.get(uid)
+        if compiled:
+            paths, changed, entries = compiled
+            if [self.modified(path) for path in paths] == changed:
+                return entries
+        # (the mtimes are taken before compiling, so a change made
+        # while it is compiled is caught next time)
+        paths = self.dependencies(playlist)
+        changed = paths and [self.modified(path) for path in paths]
+        entries = queue_entries([playlist])
+        if paths:
+            self.compiled[uid] = (paths, changed, entries)
+        else:
+            self.compiled.pop(uid, None)
+        return entries
 
 
 class NFCReader(PlayerErrors):
@@ -507,88 +1020,40 @@ class NFCReader(PlayerErrors):
         if not self.uart_found:
             return
 
-        redis = Redis()
+        redis = storage.connect()
+        playlists = NFCPlaylists(NFC_DIR)
         last = {}
         while True:
+            metrics.nfc_polls.inc()
             try:
                 uid = self.pn532.read_passive_target(timeout=0.5)
             except RuntimeError as e:
                 if 'Did not receive expected ACK' not in str(e):
+                    metrics.nfc_errors.inc()
                     self.error('NFC: %s' % e)
                 uid = None
 
             if uid:
-                playlist = 'nfc/%s.m3u' % bytes.hex(uid)
+                uid = bytes.hex(uid)
                 try:
                     # don't retrigger from the same NFC (it is "seen" multiple
                     # times in quick succession if not moved away quickly)
-                    if last[playlist] + timedelta(seconds=10) > datetime.now():
+                    if last[uid] + timedelta(seconds=10) > datetime.now():
                         continue
                 except KeyError:
                     pass
-                clear_queue()
-                skip_current_track()
-                queue_file(playlist)
-                last[playlist] = datetime.now()
+                entries = playlists.entries(uid)
+                if entries is None:
+                    continue
+                metrics.nfc_tap_to_audio.begin()
+                replace_queue_entries(
+                    redis, entries, json.dumps(command_request('skip')),
+                )
+                last[uid] = datetime.now()
 
 
 def clear_queue():
-    redis = Redis()
-    redis.ltrim('queue', 1, 0)
-
-
-def queue_file(file, prepend=False):
-    redis = Redis()
-    if os.path.exists(file):
-        guessed_type = guess_type(file)[0]
-        if guessed_type == 'audio/mpegurl':
-            queue_playlist(file, prepend)
-        elif guessed_type.startswith('audio/'):
-            track = os.path.realpath(file)
-            tags = TinyTag.get(track)
-            if prepend:
-                redis.lpush(
-                    'queue',
-                    json.dumps({'file': track, 'tags': tags.as_dict()}),
-                )
-            else:
-                redis.rpush(
-                    'queue',
-                    json.dumps({'file': track, 'tags': tags.as_dict()}),
-                )
-        else:
-            PlayerErrors().error('UNKNOWN FILE TYPE "%"' % file)
-    else:
-        PlayerErrors().error('NO FILE "%s"' % file)
-
-
-def queue_playlist(file, prepend=False):
-    tracks = []
-    with open(file) as playlist:
-        for line in playlist.readlines():
-            if line.startswith('#'):
-                continue
-            tracks.append(line.strip())
-    queue_files(tracks, prepend)
-
-
-def queue_directory(dir, prepend=False):
-    for root, dirs, files in os.walk(dir, topdown=True):
-        dirs.sort(reverse=prepend)
-        files.sort()
-        queue_files([os.path.join(root, file) for file in files], prepend)
-
-
-def queue_files(files, prepend=False):
-    if files[0] == '-':
-        files = [ line.rstrip() for line in sys.stdin ]
-    if prepend:
-        files = reversed(files)
-    for file in files:
-        if os.path.isdir(file):
-            queue_directory(file, prepend)
-        else:
-            queue_file(file, prepend)
+    playqueue.clear(storage.connect())
 
 
 def shorten(text, target):
@@ -597,12 +1062,8 @@ def shorten(text, target):
     return text.ljust(target)
 
 
-def format_track_text(track, flag=None):
-    try:
-        width = os.get_terminal_size()[0]
-    except OSError:
-        width = 80
-    avail = width - 14
+def format_track_text(track, flag=None, state=None):
+    avail = renderer.shared().width - 14
     title_width = round(avail * 0.4)
     avail = avail - title_width
     album_width = round(avail * 0.5)
@@ -628,15 +1089,15 @@ def format_track_text(track, flag=None):
         tracks = 1
 
     if not flag:
+        if not state:
+            state = storage.connect().get('state')
+            if state:
+                state = state.decode()
         flag = '◼'
-        redis = Redis()
-        state = redis.get('state')
-        if state:
-            state = state.decode()
-            if state == 'playing':
-                flag = '▶'
-            elif state == 'paused':
-                flag = '‖'
+        if state == 'playing':
+            flag = '▶'
+        elif state == 'paused':
+            flag = '‖'
     return f'{flag} {title} | {num:02d}/{tracks:02d} {album} | {artist}'
 
 
@@ -650,13 +1111,27 @@ def play(file):
 
 
 @click.command()
-def spin():
+@click.option('--gapless', is_flag=True)
+@click.option('--fps', default=5, show_default=True)
+@click.option('--daemon', is_flag=True)
+@click.option('--metrics-port', type=int)
+@click.option('--metrics-address', default='127.0.0.1', show_default=True)
+def spin(gapless, fps, daemon, metrics_port, metrics_address):
+    # keep retrying through redis restarts rather than exiting
+    storage.configure(retries=-1, cache_hot_keys=True)
     loop = GLib.MainLoop()
+    if metrics_port:
+        metrics.serve(metrics_port, metrics_address)
+    if daemon:
+        # set before anything else can write to the terminal
+        renderer.shared().headless = True
     scrobbler = Scrobbler()
     threading.Thread(target=scrobbler.scrobble_plays, daemon=True).start()
     reader = NFCReader()
     threading.Thread(target=reader.listen, daemon=True).start()
-    player = Player(loop=loop)
+    player = Player(loop=loop, gapless=gapless, fps=fps, headless=daemon)
+    server = control.ControlServer(player)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
     threading.Thread(target=player.spin).start()
     loop.run()
 
@@ -665,24 +1140,52 @@ def spin():
 @click.option('--clear', is_flag=True)
 @click.option('--prepend', is_flag=True)
 @click.option('--remove', is_flag=True)
+@click.option('--move', is_flag=True)
+@click.option('--after')
+@click.option('--dedupe', is_flag=True)
+@click.option('--stats', is_flag=True)
+@click.option('--search', 'find', is_flag=True)
 @click.argument('tracks', nargs=-1)
-def queue(clear, prepend, remove, tracks):
-    redis = Redis()
+def queue(clear, prepend, remove, move, after, dedupe, stats, find, tracks):
+    redis = storage.connect()
+    if find and tracks:
+        # the arguments are words to look for rather than files
+        query = tracks
+        tracks = search.search_files(redis, query)
+        if not tracks:
+            PlayerErrors().error('NO MATCHES "%s"' % ' '.join(query))
+            sys.exit(1)
     if clear:
         clear_queue()
     if remove:
-        for file in tracks:
-            track = os.path.realpath(file)
-            redis.lrem('queue', 0, track)
+        playqueue.remove(redis, [track_id(file) for file in tracks])
+    elif move or after:
+        if move:
+            placed = playqueue.insert(
+                redis,
+                [track_id(file) for file in tracks],
+                after=track_id(after) if after else None,
+                move=True,
+            )
+        else:
+            placed = insert_after(tracks, after)
+        if placed is None:
+            PlayerErrors().error('NOT QUEUED "%s"' % after)
     else:
         if tracks:
-            queue_files(tracks, prepend)
+            # the player is told as each batch is queued, so it can
+            # start on the first while the rest are still being read
+            enqueuer = enqueue(tracks, prepend, notify=lambda: send_command('queued'))
+            if stats:
+                print('queued', enqueuer.stats())
+    if dedupe:
+        print('removed %d duplicates' % playqueue.dedupe(redis))
+    send_command('queued')
 
 
 def show_queued_tracks(count=-1):
-    redis = Redis()
-    for entry in redis.lrange('queue', 0, count-1):
-        track = json.loads(entry.decode())
+    redis = storage.connect()
+    for track in load_tracks(redis, playqueue.track_ids(redis, 0, count-1)):
         print(format_track_text(track, flag=' '))
 
 
@@ -692,15 +1195,21 @@ def show_queue(repeat):
     show_queued_tracks()
     while repeat:
         time.sleep(repeat)
-        os.system('clear')
+        renderer.shared().clear()
         show_queued_tracks()
 
 
-def show_previous_tracks(count=-1):
-    redis = Redis()
-    for entry in reversed(redis.lrange('recently_played', 0, count-1)):
-        track = json.loads(entry.decode())
-        print(format_track_text(track, flag=' '))
+def show_previous_tracks(count=100):
+    redis = storage.connect()
+    plays = history.recent_plays(redis, count)
+    tracks = {
+        track['id']: track
+        for track in load_tracks(redis, [play['id'] for play in plays])
+    }
+    for play in plays:
+        if play['id'] in tracks:
+            flag = '✗' if play['skipped'] else ' '
+            print(format_track_text(tracks[play['id']], flag=flag))
 
 
 @click.command()
@@ -709,19 +1218,64 @@ def show_previous(repeat):
     show_previous_tracks()
     while repeat:
         time.sleep(repeat)
-        os.system('clear')
+        renderer.shared().clear()
         show_previous_tracks()
 
 
 def show_current_track():
-    redis = Redis()
-    track = redis.get('current_track')
+    status = control.request({'command': 'status'})
+    if status:
+        track = status['track']
+        state = status['state']
+    else:
+        redis = storage.connect()
+        track = redis.get('current_track')
+        if track:
+            track = load_track(redis, track)
+        state = None
     if track:
-        print(format_track_text(json.loads(track.decode())))
+        print(format_track_text(track, state=state))
     else:
         print('◼ [nothing playing]')
 
 
+@click.command(name='history')
+@click.option('--since', type=click.DateTime())
+@click.option('--until', type=click.DateTime())
+@click.argument('tracks', nargs=-1)
+def show_history(since, until, tracks):
+    redis = storage.connect()
+    if tracks:
+        for file in tracks:
+            id = track_id(file)
+            last = history.last_played(redis, id)
+            if last:
+                last = datetime.fromtimestamp(last).strftime('%Y-%m-%d %H:%M')
+            print('%5d plays, last %s  %s' % (
+                history.play_count(redis, id),
+                last or 'never',
+                file,
+            ))
+        return
+    plays = history.plays_between(
+        redis,
+        since.timestamp() if since else None,
+        until.timestamp() if until else None,
+    )
+    tracks = {
+        track['id']: track
+        for track in load_tracks(redis, [play['id'] for play in plays])
+    }
+    for play in plays:
+        track = tracks.get(play['id'])
+        if track:
+            started = datetime.fromtimestamp(play['started'])
+            print('%s %s' % (
+                started.strftime('%Y-%m-%d %H:%M'),
+                format_track_text(track, flag='✗' if play['skipped'] else ' '),
+            ))
+
+
 @click.command()
 def show_playing():
     show_current_track()
@@ -730,77 +1284,72 @@ def show_playing():
 @click.command()
 @click.option('--repeat', default=0, show_default=True)
 def show_summary(repeat):
-    try:
-        height = os.get_terminal_size()[1]
-    except OSError:
-        height = 24
+    if repeat:
+        storage.configure(cache_hot_keys=True)
+    height = renderer.shared().height
     show_previous_tracks(int(height/2) - 2)
     show_current_track()
     show_queued_tracks(int(height/2))
     while repeat:
         time.sleep(repeat)
-        os.system('clear')
-        try:
-            height = os.get_terminal_size()[1]
-        except OSError:
-            height = 24
+        renderer.shared().clear()
+        height = renderer.shared().height
         show_previous_tracks(int(height/2) - 2)
         show_current_track()
         show_queued_tracks(int(height/2))
 
 
 @click.command()
-def pause():
-    redis = Redis()
-    redis.set('command', 'pause')
+@click.option('--wait', is_flag=True)
+def pause(wait):
+    send_command('pause', wait)
 
 
-def skip_current_track():
-    redis = Redis()
-    redis.set('command', 'skip')
+def skip_current_track(wait=False):
+    send_command('skip', wait)
 
 
 @click.command()
-def skip():
-    skip_current_track()
+@click.option('--wait', is_flag=True)
+def skip(wait):
+    skip_current_track(wait)
 
 
 @click.command()
-def next_track():
-    redis = Redis()
-    redis.set('command', 'next')
+@click.option('--wait', is_flag=True)
+def next_track(wait):
+    send_command('next', wait)
 
 
 @click.command()
-def previous_track():
-    redis = Redis()
-    redis.set('command', 'previous')
+@click.option('--wait', is_flag=True)
+def previous_track(wait):
+    send_command('previous', wait)
 
 
 @click.command()
-def stop():
-    redis = Redis()
-    redis.set('command', 'stop')
+@click.option('--wait', is_flag=True)
+def stop(wait):
+    send_command('stop', wait)
 
 
 @click.command()
-def quit():
-    redis = Redis()
-    redis.set('command', 'quit')
+@click.option('--wait', is_flag=True)
+def quit(wait):
+    send_command('quit', wait)
 
 
 @click.command()
 @click.argument('tracks', nargs=-1)
 def interrupt(tracks):
-    redis = Redis()
-    track = redis.getdel('current_track')
-    if track:
-        redis.lpush('queue', track)
-    for file in reversed(tracks):
-        track = os.path.realpath(file)
-        tags = TinyTag.get(track)
-        redis.lpush(
-            'queue',
-            json.dumps({'file': track, 'tags': tags.as_dict()}),
-        )
-    redis.set('command', 'skip')
+    # requeue what is playing, queue the tracks ahead of it, and skip
+    # to the first of them, atomically
+    redis = storage.connect()
+    args = [json.dumps(command_request('skip'))]
+    for track in cached_tracks(redis, tracks):
+        args += [track['id'], track_record(track)]
+    redis.script(
+        'interrupt',
+        ['current_track', *playqueue.QUEUE_KEYS, 'tracks', 'commands'],
+        args,
+    )
@@ -0,0 +1,77 @@
+from mimetypes import guess_type
+import os
+from urllib.parse import unquote, urlparse
+
+
+# .m3u is audio/mpegurl, .m3u8 application/vnd.apple.mpegurl, and
+# there are x- variants of both about
+PLAYLIST_TYPES = {
+    'audio/mpegurl',
+    'audio/x-mpegurl',
+    'application/vnd.apple.mpegurl',
+    'application/x-mpegurl',
+}
+
+
+def is_playlist(path):
+    return guess_type(path)[0] in PLAYLIST_TYPES
+
+
+def decode(line, utf8):
+    # .m3u8 is UTF-8 by definition; plain .m3u is whatever the program
+    # that wrote it used, which is UTF-8 or (from older players) Latin-1
+    try:
+        return line.decode('utf-8')
+    except UnicodeDecodeError:
+        if utf8:
+            return line.decode('utf-8', errors='replace')
+        return line.decode('latin-1')
+
+
+def extinf(line):
+    # #EXTINF:<seconds> [attributes],<artist> - <title>, as tags when it
+    # gives all three
+    duration, comma, name = line[len('#EXTINF:'):].partition(',')
+    artist, dash, title = name.partition(' - ')
+    try:
+        duration = float(duration.split()[0])
+    except (IndexError, ValueError):
+        return None
+    if not comma or not dash or duration < 0 or not artist.strip() or not title.strip():
+        return None
+    return {'artist': artist.strip(), 'title': title.strip(), 'duration': duration}
+
+
+def entry_path(entry, base):
+    # normalised, so ../Album/01.mp3 is the same track wherever the
+    # playlist that gave it is
+    if entry.startswith('file://'):
+        return os.path.normpath(unquote(urlparse(entry).path))
+    return os.path.normpath(os.path.join(base, entry))
+
+
+def read_playlist(path):
+    # yields each entry's path (relative ones are relative to the
+    # playlist, not the current directory) with the tags its #EXTINF
+    # line gave, or None; read a line at a time, so big playlists
+    # aren't held in memory
+    base = os.path.dirname(os.path.abspath(path))
+    utf8 = path.lower().endswith('.m3u8')
+    tags = None
+    with open(path, 'rb') as playlist:
+        for number, line in enumerate(playlist):
+            if number == 0 and line.startswith(b'\xef\xbb\xbf'):
+                line = line[3:]
+            line = decode(line, utf8).strip()
+            if not line:
+                continue
+            if line.startswith('#'):
+                if line.startswith('#EXTINF:'):
+                    tags = extinf(line)
+                continue
+            if '://' in line and not line.startswith('file://'):
+                # streams aren't something deck can queue
+                tags = None
+                continue
+            yield entry_path(line, base), tags
+            tags = None
@@ -0,0 +1,62 @@
+# the queue's keys, in the order the queue scripts expect them (see
+# QUEUE_FUNCTIONS in deck.redis for how the queue is kept)
+QUEUE_KEYS = ['queue', 'queue:index', 'queue:serial']
+
+
+def entry_track(entry):
+    if isinstance(entry, bytes):
+        entry = entry.decode()
+    return entry.split(':')[0]
+
+
+def push(redis, ids, head=False):
+    # IDs in play order, at the tail or the head of the queue
+    if ids:
+        redis.script('push_tracks', QUEUE_KEYS, [int(head), *ids])
+
+
+def pop(redis):
+    # the head of the queue and its track table entry, or None
+    return redis.script('pop_track', QUEUE_KEYS + ['tracks'])
+
+
+def peek(redis):
+    entries = redis.zrange('queue', 0, 0)
+    if entries:
+        return entry_track(entries[0])
+    return None
+
+
+def track_ids(redis, start=0, end=-1):
+    return [entry_track(entry) for entry in redis.zrange('queue', start, end)]
+
+
+def length(redis):
+    return redis.zcard('queue')
+
+
+def clear(redis):
+    pipeline = redis.pipeline()
+    pipeline.delete('queue')
+    pipeline.delete('queue:index')
+    pipeline.execute()
+
+
+def remove(redis, ids):
+    if not ids:
+        return 0
+    return redis.script('remove_tracks', QUEUE_KEYS, ids)
+
+
+def insert(redis, ids, after=None, move=False):
+    # after the first entry of a track, or at the head; returns None
+    # when that track is not queued
+    return redis.script(
+        'insert_tracks',
+        QUEUE_KEYS,
+        [after or '', int(move), *ids],
+    )
+
+
+def dedupe(redis):
+    return redis.script('dedupe', QUEUE_KEYS)
@@ -1,48 +1,640 @@
+import os
 import redis
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
+import threading
+import time
+from deck import metrics
+from deck.storage import STREAM_LENGTH, Storage
 
 
-class Redis:
+# small keys read far more often than they change, which long-running
+# processes can cache locally (see configure)
+CACHED_KEYS = ['state', 'volume', 'muted']
+
+# the queue is a sorted set of entries scored by position, with an
+# index of the same entries in track order (all scored 0, so they sort
+# by name); an entry is a track ID and a serial number, so a track can
+# be queued more than once. Scripts using these are given the queue,
+# index and serial keys one after the other.
+QUEUE_FUNCTIONS = '''
+    local function entry_track(entry)
+        return string.sub(entry, 1, string.find(entry, ':') - 1)
+    end
+
+    local function args_from(first)
+        -- ARGV from the first'th on; (unpack runs out of stack with
+        -- more than a few thousand)
+        local args = {}
+        for i = first, #ARGV do
+            args[#args + 1] = ARGV[i]
+        end
+        return args
+    end
+
+    local function track_entries(index, id)
+        return redis.call(
+            'ZRANGEBYLEX', index, '[' .. id .. ':', '(' .. id .. ';'
+        )
+    end
+
+    local function first_entry(queue, index, id)
+        local first, lowest
+        for _, entry in ipairs(track_entries(index, id)) do
+            local score = tonumber(redis.call('ZSCORE', queue, entry))
+            if not lowest or score < lowest then
+                first, lowest = entry, score
+            end
+        end
+        return first
+    end
+
+    local function new_entries(index, serial, ids)
+        local entries = {}
+        local last = redis.call('INCRBY', serial, #ids)
+        for i, id in ipairs(ids) do
+            entries[i] = id .. ':' .. (last - #ids + i)
+            redis.call('ZADD', index, 0, entries[i])
+        end
+        return entries
+    end
+
+    local function bounds(queue, after)
+        -- the scores either side of the gap after an entry, or at the
+        -- head of the queue
+        local lower, upper
+        if after then
+            -- the score as redis has it, which converting to a Lua
+            -- number and back could round
+            local score = redis.call('ZSCORE', queue, after)
+            lower = tonumber(score)
+            local next = redis.call(
+                'ZRANGEBYSCORE', queue, '(' .. score, '+inf',
+                'WITHSCORES', 'LIMIT', 0, 1
+            )
+            upper = tonumber(next[2])
+        else
+            upper = tonumber(redis.call('ZRANGE', queue, 0, 0, 'WITHSCORES')[2])
+        end
+        return lower, upper
+    end
+
+    local function place(queue, entries, after)
+        -- score the entries (in order) into the gap after an entry, or
+        -- at the head when after is false
+        local lower, upper = bounds(queue, after)
+        local step = 1
+        if lower and upper then
+            step = (upper - lower) / (#entries + 1)
+            if lower + step <= lower or lower + step * #entries >= upper then
+                -- run out of room between the two, so space the
+                -- whole queue out again
+                for i, entry in ipairs(redis.call('ZRANGE', queue, 0, -1)) do
+                    redis.call('ZADD', queue, i, entry)
+                end
+                lower, upper = bounds(queue, after)
+                step = (upper - lower) / (#entries + 1)
+            end
+        end
+        if not lower then
+            lower = (upper or 1) - step * (#entries + 1)
+        end
+        local args = {}
+        for i, entry in ipairs(entries) do
+            args[#args + 1] = lower + step * i
+            args[#args + 1] = entry
+            if #args >= 1000 or i == #entries then
+                redis.call('ZADD', queue, unpack(args))
+                args = {}
+            end
+        end
+    end
+
+    local function push(queue, index, serial, ids, head)
+        if #ids == 0 then
+            return
+        end
+        local after = false
+        if not head then
+            after = redis.call('ZRANGE', queue, -1, -1)[1] or false
+        end
+        place(queue, new_entries(index, serial, ids), after)
+    end
+
+    local function clear(queue, index)
+        redis.call('DEL', queue, index)
+    end
+'''
+
+# operations that would otherwise take several round trips, and race
+# with other clients changing the queue between them
+SCRIPTS = {
+    # KEYS: queue, queue:index, queue:serial
+    # ARGV: at the head (0/1), then track IDs in play order
+    'push_tracks': QUEUE_FUNCTIONS + '''
+        push(KEYS[1], KEYS[2], KEYS[3], args_from(2), ARGV[1] == '1')
+    ''',
+
+    # KEYS: queue, queue:index, queue:serial, tracks
+    'pop_track': QUEUE_FUNCTIONS + '''
+        local popped = redis.call('ZPOPMIN', KEYS[1])
+        if not popped[1] then
+            return nil
+        end
+        redis.call('ZREM', KEYS[2], popped[1])
+        local id = entry_track(popped[1])
+        return {id, redis.call('HGET', KEYS[4], id)}
+    ''',
+
+    # KEYS: queue, queue:index, queue:serial
+    # ARGV: track IDs, every entry of which is removed
+    'remove_tracks': QUEUE_FUNCTIONS + '''
+        local removed = 0
+        for _, id in ipairs(ARGV) do
+            for _, entry in ipairs(track_entries(KEYS[2], id)) do
+                redis.call('ZREM', KEYS[1], entry)
+                redis.call('ZREM', KEYS[2], entry)
+                removed = removed + 1
+            end
+        end
+        return removed
+    ''',
+
+    # KEYS: queue, queue:index, queue:serial
+    # ARGV: track ID to go after (or empty for the head), move (0/1),
+    #       then track IDs in play order
+    # moving takes the first entry of each track from where it is,
+    # rather than adding new ones; returns nil when the track to go
+    # after is not queued
+    'insert_tracks': QUEUE_FUNCTIONS + '''
+        local after = false
+        if ARGV[1] ~= '' then
+            after = first_entry(KEYS[1], KEYS[2], ARGV[1])
+            if not after then
+                return nil
+            end
+        end
+        local ids = args_from(3)
+        local entries = {}
+        if ARGV[2] == '1' then
+            for _, id in ipairs(ids) do
+                local entry = first_entry(KEYS[1], KEYS[2], id)
+                if entry and entry ~= after then
+                    redis.call('ZREM', KEYS[1], entry)
+                    entries[#entries + 1] = entry
+                end
+            end
+        else
+            entries = new_entries(KEYS[2], KEYS[3], ids)
+        end
+        if #entries > 0 then
+            place(KEYS[1], entries, after)
+        end
+        return #entries
+    ''',
+
+    # KEYS: queue, queue:index, queue:serial
+    # keeps the first entry of each track; returns how many were removed
+    'dedupe': QUEUE_FUNCTIONS + '''
+        local removed = 0
+        local entries = redis.call('ZRANGE', KEYS[2], 0, -1)
+        local i = 1
+        while i <= #entries do
+            local id = entry_track(entries[i])
+            local j = i
+            while entries[j + 1] and entry_track(entries[j + 1]) == id do
+                j = j + 1
+            end
+            if j > i then
+                local first = first_entry(KEYS[1], KEYS[2], id)
+                for k = i, j do
+                    if entries[k] ~= first then
+                        redis.call('ZREM', KEYS[1], entries[k])
+                        redis.call('ZREM', KEYS[2], entries[k])
+                        removed = removed + 1
+                    end
+                end
+            end
+            i = j + 1
+        end
+        return removed
+    ''',
+
+    # KEYS: current_track, queue, queue:index, queue:serial,
+    #       recently_played, scrobbles, history, history:by_time,
+    #       history:serial, history:track:<id>, history:plays,
+    #       history:last_played
+    # ARGV: track id, requeue (0/1), add to recently played (0/1),
+    #       time started (or empty to not scrobble), stream length,
+    #       history entry, time started
+    'finish_track': QUEUE_FUNCTIONS + '''
+        redis.call('DEL', KEYS[1])
+        if ARGV[2] == '1' then
+            push(KEYS[2], KEYS[3], KEYS[4], {ARGV[1]}, true)
+        end
+        if ARGV[3] == '1' then
+            redis.call('LPUSH', KEYS[5], ARGV[1])
+            redis.call('LTRIM', KEYS[5], 0, 99)
+        end
+        if ARGV[4] ~= '' then
+            redis.call(
+                'XADD', KEYS[6], 'MAXLEN', '~', ARGV[5], '*',
+                'type', 'played', 'id', ARGV[1], 'started', ARGV[4]
+            )
+        end
+        local play = redis.call('INCR', KEYS[9])
+        redis.call('HSET', KEYS[7], play, ARGV[6])
+        redis.call('ZADD', KEYS[8], ARGV[7], play)
+        redis.call('ZADD', KEYS[10], ARGV[7], play)
+        redis.call('HINCRBY', KEYS[11], ARGV[1], 1)
+        redis.call('HSET', KEYS[12], ARGV[1], ARGV[7])
+    ''',
+
+    # KEYS: recently_played, queue, queue:index, queue:serial
+    'previous': QUEUE_FUNCTIONS + '''
+        local id = redis.call('LPOP', KEYS[1])
+        if id then
+            push(KEYS[2], KEYS[3], KEYS[4], {id}, true)
+        end
+        return id
+    ''',
+
+    # KEYS: current_track, queue, queue:index, queue:serial, tracks,
+    #       commands
+    # ARGV: command, then track id and entry pairs in play order
+    'interrupt': QUEUE_FUNCTIONS + '''
+        local current = redis.call('GET', KEYS[1])
+        redis.call('DEL', KEYS[1])
+        if current then
+            push(KEYS[2], KEYS[3], KEYS[4], {current}, true)
+        end
+        local ids = {}
+        for i = 2, #ARGV - 1, 2 do
+            redis.call('HSET', KEYS[5], ARGV[i], ARGV[i + 1])
+            ids[#ids + 1] = ARGV[i]
+        end
+        push(KEYS[2], KEYS[3], KEYS[4], ids, true)
+        redis.call('RPUSH', KEYS[6], ARGV[1])
+    ''',
+
+    # KEYS: queue, queue:index, queue:serial, tracks, commands
+    # ARGV: command (or empty), then track id and entry pairs in order
+    'replace_queue': QUEUE_FUNCTIONS + '''
+        clear(KEYS[1], KEYS[2])
+        local ids = {}
+        for i = 2, #ARGV - 1, 2 do
+            redis.call('HSET', KEYS[4], ARGV[i], ARGV[i + 1])
+            ids[#ids + 1] = ARGV[i]
+        end
+        push(KEYS[1], KEYS[2], KEYS[3], ids, false)
+        if ARGV[1] ~= '' then
+            redis.call('RPUSH', KEYS[5], ARGV[1])
+        end
+    ''',
+
+    # KEYS: history, history:plays, history:last_played, and the marker
+    #       set once it has been done
+    # the play stats for plays recorded before they were kept, rebuilt
+    # from the whole history (so plays already counted aren't counted
+    # twice), atomically so finish_track can't count one in between
+    'backfill_play_stats': '''
+        if redis.call('EXISTS', KEYS[4]) == 1 then
+            return 0
+        end
+        local plays = {}
+        local last_played = {}
+        local entries = redis.call('HVALS', KEYS[1])
+        for _, entry in ipairs(entries) do
+            local play = cjson.decode(entry)
+            plays[play.id] = (plays[play.id] or 0) + 1
+            if not last_played[play.id] or play.started > last_played[play.id] then
+                last_played[play.id] = play.started
+            end
+        end
+        redis.call('DEL', KEYS[2], KEYS[3])
+        for id, count in pairs(plays) do
+            redis.call('HSET', KEYS[2], id, count)
+            redis.call('HSET', KEYS[3], id, string.format('%.6f', last_played[id]))
+        end
+        redis.call('SET', KEYS[4], 1)
+        return #entries
+    ''',
+}
+
+settings = {
+    'url': os.environ.get('DECK_REDIS_URL', 'redis://localhost:6379'),
+    # short-lived commands give up quickly when redis is down
+    'retries': 3,
+}
+pool = None
+cache = None
+scripts = {}
+
+
+def configure(retries=None, cache_hot_keys=False):
+    # must be called before the first Redis() is created; spin retries
+    # forever so it survives redis restarting underneath it
+    global cache
+    if retries is not None:
+        settings['retries'] = retries
+    if cache_hot_keys and not cache:
+        cache = HotKeyCache(connection_pool(), Redis().key, CACHED_KEYS)
+
+
+def connection_pool():
+    # one pool per process, shared by every Redis(); redis-py uses the
+    # hiredis parser on its own when it is installed
+    global pool
+    if not pool:
+        pool = redis.ConnectionPool.from_url(
+            settings['url'],
+            retry=Retry(
+                ExponentialBackoff(cap=5, base=0.05),
+                settings['retries'],
+            ),
+            retry_on_error=[
+                redis.exceptions.ConnectionError,
+                redis.exceptions.TimeoutError,
+            ],
+            health_check_interval=30,
+        )
+    return pool
+
+
+class HotKeyCache:
+    # client-side caching using server-assisted invalidation: redis
+    # tells us (in broadcast mode, for the key prefixes given) whenever
+    # one of the keys changes, and the local copy is dropped
+    def __init__(self, pool, key, keys):
+        self.pool = pool
+        self.prefixes = [key(name) for name in keys]
+        self.values = {}
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.active = False
+        threading.Thread(target=self.listen, daemon=True).start()
+
+    def connection(self):
+        # connections of our own, outside the pool, as they are held
+        # for as long as tracking is wanted
+        return self.pool.connection_class(**self.pool.connection_kwargs)
+
+    def listen(self):
+        delay = 0.05
+        while True:
+            listener = self.connection()
+            tracker = self.connection()
+            try:
+                listener.send_command('CLIENT', 'ID')
+                client = listener.read_response()
+                listener.send_command('SUBSCRIBE', '__redis__:invalidate')
+                listener.read_response()
+                prefixes = []
+                for prefix in self.prefixes:
+                    prefixes += ['PREFIX', prefix]
+                tracker.send_command(
+                    'CLIENT', 'TRACKING', 'ON',
+                    'REDIRECT', client, 'BCAST', *prefixes,
+                )
+                tracker.read_response()
+                self.active = True
+                delay = 0.05
+                while True:
+                    message = listener.read_response()
+                    if message[0] != b'message':
+                        continue
+                    if message[2] is None:
+                        # the whole database was flushed
+                        self.invalidate_all()
+                    else:
+                        for key in message[2]:
+                            self.invalidate(key.decode())
+            except redis.exceptions.ResponseError:
+                # a redis without tracking (older than 6), don't cache
+                return
+            except (redis.exceptions.ConnectionError, OSError):
+                pass
+            finally:
+                self.active = False
+                self.invalidate_all()
+                listener.disconnect()
+                tracker.disconnect()
+            time.sleep(delay)
+            delay = min(delay * 2, 5)
+
+    def get(self, key, fetch):
+        if not self.active:
+            return fetch()
+        with self.lock:
+            if key in self.values:
+                return self.values[key]
+            generation = self.generations.get(key, 0)
+        value = fetch()
+        with self.lock:
+            # don't keep a value that was changed while fetching it
+            if self.active and self.generations.get(key, 0) == generation:
+                self.values[key] = value
+        return value
+
+    def invalidate(self, key):
+        with self.lock:
+            self.values.pop(key, None)
+            self.generations[key] = self.generations.get(key, 0) + 1
+
+    def invalidate_all(self):
+        with self.lock:
+            for key in list(self.values) + list(self.generations):
+                self.generations[key] = self.generations.get(key, 0) + 1
+            self.values = {}
+
+
+class Redis(Storage):
     def __init__(self):
-        self.redis = redis.Redis()
+        self.redis = redis.Redis(connection_pool=connection_pool())
         self.namespace = 'deck'
 
     def key(self, key):
         return '%s:%s' % (self.namespace, key)
 
+    def pipeline(self, transaction=True):
+        # the same interface, but commands are queued up and
+        # sent together (and by default atomically) by execute()
+        pipeline = Redis.__new__(Redis)
+        pipeline.namespace = self.namespace
+        pipeline.redis = self.redis.pipeline(transaction=transaction)
+        return pipeline
+
+    def execute(self):
+        return self.timed(self.redis.execute)
+
+    def script(self, name, keys, args=[]):
+        # loaded once per process, then called by SHA
+        if name not in scripts:
+            scripts[name] = self.redis.register_script(SCRIPTS[name])
+        return self.timed(
+            scripts[name],
+            [self.key(key) for key in keys],
+            args,
+            self.redis,
+        )
+
+    def timed(self, command, *args):
+        # commands on a pipeline are only queued, so on a pipeline it is
+        # the execute() sending them that is timed
+        pipelined = isinstance(self.redis, redis.client.Pipeline)
+        if pipelined and command != self.redis.execute:
+            return command(*args)
+        started = time.monotonic()
+        try:
+            return command(*args)
+        finally:
+            metrics.redis_commands.observe(time.monotonic() - started)
+
+    def blpop(self, key, timeout=0):
+        popped = self.redis.blpop(self.key(key), timeout)
+        if popped:
+            return popped[1]
+        return None
+
+    def written(self, key, result=None):
+        # writes drop the local copy straight away, rather than waiting
+        # for redis to tell us about our own change
+        if cache and key in CACHED_KEYS:
+            cache.invalidate(self.key(key))
+        return result
+
     def delete(self, key):
-        return self.redis.delete(self.key(key))
+        return self.written(key, self.timed(self.redis.delete, self.key(key)))
+
+    def expire(self, key, seconds):
+        return self.timed(self.redis.expire, self.key(key), seconds)
 
     def get(self, key):
-        return self.redis.get(self.key(key))
+        if cache and key in CACHED_KEYS:
+            return cache.get(
+                self.key(key),
+                lambda: self.timed(self.redis.get, self.key(key)),
+            )
+        return self.timed(self.redis.get, self.key(key))
 
     def getdel(self, key):
         try:
-            value = self.redis.getdel(self.key(key))
+            value = self.timed(self.redis.getdel, self.key(key))
         except redis.exceptions.ResponseError:
-            value = self.redis.get(self.key(key))
-            self.redis.delete(self.key(key))
-        return value
+            value = self.timed(self.redis.get, self.key(key))
+            self.timed(self.redis.delete, self.key(key))
+        return self.written(key, value)
+
+    def hdel(self, key, *fields):
+        return self.timed(self.redis.hdel, self.key(key), *fields)
+
+    def hget(self, key, field):
+        return self.timed(self.redis.hget, self.key(key), field)
+
+    def hgetall(self, key):
+        return self.timed(self.redis.hgetall, self.key(key))
+
+    def hincrby(self, key, field, amount=1):
+        return self.timed(self.redis.hincrby, self.key(key), field, amount)
+
+    def hset(self, key, field, value):
+        return self.timed(self.redis.hset, self.key(key), field, value)
+
+    def hset_many(self, key, mapping):
+        return self.timed(self.redis.hset, self.key(key), None, None, mapping)
+
+    def hmget(self, key, fields):
+        return self.timed(self.redis.hmget, self.key(key), fields)
 
     def lindex(self, key, index):
-        return self.redis.lindex(self.key(key), index)
+        return self.timed(self.redis.lindex, self.key(key), index)
+
+    def llen(self, key):
+        return self.timed(self.redis.llen, self.key(key))
 
     def lpop(self, key):
-        return self.redis.lpop(self.key(key))
+        return self.timed(self.redis.lpop, self.key(key))
 
-    def lpush(self, key, value):
-        return self.redis.lpush(self.key(key), value)
+    def lpush(self, key, *values):
+        return self.timed(self.redis.lpush, self.key(key), *values)
 
     def lrange(self, key, lower, upper):
-        return self.redis.lrange(self.key(key), lower, upper)
+        return self.timed(self.redis.lrange, self.key(key), lower, upper)
 
     def lrem(self, key, count, element):
-        return self.redis.lrem(self.key(key), count, element)
+        return self.timed(self.redis.lrem, self.key(key), count, element)
 
     def ltrim(self, key, lower, upper):
-        return self.redis.ltrim(self.key(key), lower, upper)
+        return self.timed(self.redis.ltrim, self.key(key), lower, upper)
+
+    def replace_list(self, key, values):
+        pipeline = self.pipeline()
+        pipeline.delete(key)
+        if values:
+            pipeline.rpush(key, *values)
+        return pipeline.execute()
+
+    def rpush(self, key, *values):
+        return self.timed(self.redis.rpush, self.key(key), *values)
+
+    def xack(self, key, group, id):
+        return self.timed(self.redis.xack, self.key(key), group, id)
+
+    def xadd(self, key, fields, maxlen=STREAM_LENGTH):
+        return self.timed(
+            self.redis.xadd, self.key(key), fields, '*', maxlen, True,
+        )
+
+    def xgroup_backlog(self, key, group):
+        # entries not yet delivered to the group, plus those delivered
+        # but not acknowledged
+        for info in self.timed(self.redis.xinfo_groups, self.key(key)):
+            if info['name'] in [group, group.encode()]:
+                return info['pending'] + (info.get('lag') or 0)
+        return 0
+
+    def xgroup_create(self, key, group):
+        # from the start of the stream, so nothing added before the
+        # group existed is missed
+        try:
+            return self.timed(
+                self.redis.xgroup_create, self.key(key), group, '0', True,
+            )
+        except redis.exceptions.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def xreadgroup(self, key, group, consumer, id, count=None, block=None):
+        # just the entries, for the one stream read
+        streams = self.redis.xreadgroup(
+            group, consumer, {self.key(key): id}, count, block,
+        )
+        if not streams:
+            return []
+        return streams[0][1]
+
+    def zadd(self, key, mapping):
+        return self.timed(self.redis.zadd, self.key(key), mapping)
+
+    def zcard(self, key):
+        return self.timed(self.redis.zcard, self.key(key))
+
+    def zrange(self, key, start, end, withscores=False):
+        return self.timed(
+            self.redis.zrange, self.key(key), start, end, False, withscores,
+        )
+
+    def zrangebylex(self, key, min, max):
+        return self.timed(self.redis.zrangebylex, self.key(key), min, max)
+
+    def zrangebyscore(self, key, min, max):
+        return self.timed(self.redis.zrangebyscore, self.key(key), min, max)
+
+    def zrem(self, key, *members):
+        return self.timed(self.redis.zrem, self.key(key), *members)
 
-    def rpush(self, key, value):
-        return self.redis.rpush(self.key(key), value)
+    def type(self, key):
+        return self.timed(self.redis.type, self.key(key))
 
     def set(self, key, value):
-        return self.redis.set(self.key(key), value)
+        return self.written(key, self.timed(self.redis.set, self.key(key), value))
@@ -0,0 +1,101 @@
+import os
+import signal
+import sys
+import threading
+import time
+
+
+class Renderer:
+    def __init__(self, fps=5, stream=sys.stdout):
+        self.stream = stream
+        self.headless = False
+        self.lock = threading.Lock()
+        self.set_fps(fps)
+        self.last_frame = 0
+        self.line = ''
+        self.update_size()
+        try:
+            signal.signal(signal.SIGWINCH, self.on_resize)
+        except ValueError:
+            # signal handlers can only be installed from the main thread,
+            # so the size is just read once and never updated
+            pass
+
+    def set_fps(self, fps):
+        self.interval = 1 / fps
+
+    def on_resize(self, signum, frame):
+        self.update_size()
+        # whatever was on screen has likely been rewrapped
+        self.line = ''
+
+    def update_size(self):
+        try:
+            self.width, self.height = os.get_terminal_size()
+        except OSError:
+            self.width, self.height = 80, 24
+
+    def frame_due(self):
+        return time.monotonic() - self.last_frame >= self.interval
+
+    def status(self, line):
+        # rewrite the status line in place, only sending the characters
+        # that differ from what is already on screen
+        with self.lock:
+            self.last_frame = time.monotonic()
+            if self.headless or line == self.line:
+                return
+            start = 0
+            for old, new in zip(self.line, line):
+                if old != new:
+                    break
+                start += 1
+            end = len(line)
+            if len(line) == len(self.line):
+                while end > start and line[end - 1] == self.line[end - 1]:
+                    end = end - 1
+            output = '\r'
+            if start:
+                output += '\x1b[%dC' % start
+            output += line[start:end]
+            if len(line) < len(self.line):
+                output += '\x1b[K'
+            self.write(output + '\r')
+            self.line = line
+
+    def text(self, text, end='\r\n'):
+        # a line of text which scrolls up above the status line
+        with self.lock:
+            if self.headless:
+                # plain lines, suitable for a log
+                self.write(text.rstrip() + '\n')
+            else:
+                self.write('\r' + text.ljust(self.width - 1) + end)
+            self.line = ''
+
+    def lines(self, lines, end='\r\n'):
+        with self.lock:
+            if not self.headless:
+                self.write(''.join(line + end for line in lines))
+            self.line = ''
+
+    def clear(self):
+        with self.lock:
+            if not self.headless:
+                self.write('\x1b[H\x1b[2J')
+            self.line = ''
+
+    def write(self, output):
+        self.stream.write(output)
+        self.stream.flush()
+
+
+renderer = None
+
+
+def shared():
+    # one renderer per process, so the terminal size is cached once
+    global renderer
+    if not renderer:
+        renderer = Renderer()
+    return renderer
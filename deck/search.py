@@ -0,0 +1,150 @@
+import click
+import os
+import re
+import unicodedata
+from deck import storage
+
+
+# an inverted index over the tags of every track in the library or
+# ever queued: for each word, the files with it (search:word:<word>),
+# every word in a sorted set for finding those starting with what was
+# typed (search:words), and the words each file was indexed under, so
+# they can be taken out again when it changes (search:files)
+SEARCH_TAGS = ['title', 'album', 'artist', 'albumartist']
+
+# members sorting after every word starting with a prefix
+LAST_CHARACTER = '\U0010ffff'
+
+WORD = re.compile(r'\w+')
+
+
+def normalise(text):
+    # case and accents don't matter: "Beyoncé" is found by "beyonce"
+    text = unicodedata.normalize('NFKD', str(text)).casefold()
+    return ''.join(
+        character for character in text
+        if not unicodedata.combining(character)
+    )
+
+
+def words(text):
+    return WORD.findall(normalise(text))
+
+
+def track_words(track):
+    tags = track['tags']
+    return sorted({
+        word
+        for tag in SEARCH_TAGS
+        if tags.get(tag)
+        for word in words(tags[tag])
+    })
+
+
+def word_key(word):
+    return 'search:word:%s' % word
+
+
+def index_tracks(redis, tracks):
+    # only files whose words have changed are written
+    if not tracks:
+        return
+    files = [track['file'] for track in tracks]
+    changed = {}
+    for file, track, indexed in zip(
+        files, tracks, redis.hmget('search:files', files)
+    ):
+        new = track_words(track)
+        old = indexed.decode().split() if indexed else []
+        if new != old:
+            changed[file] = (old, new)
+    if not changed:
+        return
+    # one write per word, however many files have it
+    added = {}
+    removed = {}
+    for file, (old, new) in changed.items():
+        for word in set(old) - set(new):
+            removed.setdefault(word, []).append(file)
+        for word in new:
+            added.setdefault(word, {})[file] = 0
+    pipeline = redis.pipeline()
+    for word, files in removed.items():
+        pipeline.zrem(word_key(word), *files)
+    for word, files in added.items():
+        pipeline.zadd(word_key(word), files)
+    if added:
+        pipeline.zadd('search:words', {word: 0 for word in added})
+    pipeline.hset_many('search:files', {
+        file: ' '.join(new) for file, (old, new) in changed.items()
+    })
+    pipeline.execute()
+    forget_unused(redis, removed)
+
+
+def unindex_files(redis, files):
+    if not files:
+        return
+    removed = {}
+    for file, indexed in zip(files, redis.hmget('search:files', files)):
+        for word in indexed.decode().split() if indexed else []:
+            removed.setdefault(word, []).append(file)
+    pipeline = redis.pipeline()
+    for word, indexed in removed.items():
+        pipeline.zrem(word_key(word), *indexed)
+    pipeline.hdel('search:files', *files)
+    pipeline.execute()
+    forget_unused(redis, removed)
+
+
+def forget_unused(redis, words):
+    # words no file has any more
+    words = sorted(words)
+    if not words:
+        return
+    pipeline = redis.pipeline()
+    for word in words:
+        pipeline.zcard(word_key(word))
+    unused = [word for word, count in zip(words, pipeline.execute()) if not count]
+    if unused:
+        redis.zrem('search:words', *unused)
+
+
+def search_files(redis, query):
+    # the files with every word of the query, or a word starting with
+    # it, in path order; files queued once (so indexed, but outside the
+    # library) stay in the index after they are deleted, so only those
+    # still there are returned
+    terms = words(' '.join(query))
+    if not terms:
+        return []
+    pipeline = redis.pipeline()
+    for term in terms:
+        pipeline.zrangebylex('search:words', '[' + term, '[' + term + LAST_CHARACTER)
+    expansions = [
+        [word.decode() for word in found]
+        for found in pipeline.execute()
+    ]
+    if not all(expansions):
+        return []
+    pipeline = redis.pipeline()
+    for found in expansions:
+        for word in found:
+            pipeline.zrange(word_key(word), 0, -1)
+    results = iter(pipeline.execute())
+    files = None
+    for found in expansions:
+        matching = set()
+        for word in found:
+            matching.update(next(results))
+        files = matching if files is None else files & matching
+    files = sorted(file.decode() for file in files)
+    return [file for file in files if os.path.exists(file)]
+
+
+@click.command()
+@click.argument('query', nargs=-1, required=True)
+def search(query):
+    redis = storage.connect()
+    for file in search_files(redis, query):
+        print(file)
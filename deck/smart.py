@@ -0,0 +1,274 @@
+import click
+import json
+import os
+import re
+import shlex
+import shutil
+import time
+from deck import history, storage
+from deck.control import send_command
+from deck.enqueue import enqueue
+from deck.tracks import track_id
+
+
+# smart playlists are queries over the library index (see deck.library)
+# and the play history, run over a column per field rather than track
+# by track; the columns taken from the index are kept in files (one
+# per column, mapped rather than read, so a query only pages in what
+# it uses) until the index changes, so a query costs three round trips
+# (the index's version, the play stats and the ratings) and some array
+# arithmetic
+TEXT_FIELDS = ['artist', 'albumartist', 'album', 'title', 'genre', 'path']
+NUMBER_FIELDS = ['year', 'duration', 'plays', 'played', 'rating']
+
+# played is days since the track was last played (inf if it never
+# was), and can be given in other units
+DAYS = {'d': 1, 'w': 7, 'm': 30, 'y': 365}
+
+TERM = re.compile(r'(-?)(\w+)(:|!=|<=|>=|=|<|>)(.*)')
+
+
+def cache_dir():
+    cache = os.environ.get(
+        'XDG_CACHE_HOME',
+        os.path.join(os.path.expanduser('~'), '.cache'),
+    )
+    return os.path.join(cache, 'deck', 'library')
+
+
+def tag_year(value):
+    match = re.match(r'\s*(\d{4})', str(value or ''))
+    return float(match.group(1)) if match else float('nan')
+
+
+def tag_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+def build_columns(redis):
+    import numpy
+    paths = []
+    ids = []
+    text = {field: [] for field in TEXT_FIELDS}
+    years = []
+    durations = []
+    for path, entry in redis.hgetall('library').items():
+        path = path.decode()
+        entry = json.loads(entry.decode())
+        tags = entry['tags']
+        paths.append(path)
+        ids.append(entry['id'])
+        for field in TEXT_FIELDS[:-1]:
+            text[field].append(str(tags.get(field) or '').lower())
+        text['path'].append(path.lower())
+        years.append(tag_year(tags.get('year')))
+        durations.append(tag_number(tags.get('duration')))
+    ids = numpy.array(ids, dtype='S16')
+    files = numpy.array(paths, dtype=str)
+    # each file's place in path order, to sort by without comparing
+    # strings every time
+    by_file = numpy.empty(len(files), dtype=int)
+    by_file[numpy.argsort(files)] = numpy.arange(len(files))
+    columns = {
+        'files': files,
+        'file_order': by_file,
+        'id': ids,
+        # for finding tracks by ID, in the play stats and ratings
+        'by_id': numpy.argsort(ids, kind='stable'),
+        'year': numpy.array(years, dtype=float),
+        'duration': numpy.array(durations, dtype=float),
+    }
+    for field, values in text.items():
+        columns[field] = numpy.array(values, dtype=str)
+    return columns
+
+
+def library_columns(redis):
+    import numpy
+    version = redis.get('library:version')
+    if not version:
+        raise click.ClickException(
+            'the library is empty (see "deck library scan")'
+        )
+    cache = cache_dir()
+    path = os.path.join(cache, version.decode())
+    if not os.path.isdir(path):
+        columns = build_columns(redis)
+        # written under another name then renamed, so a query running
+        # at the same time never sees half of them
+        building = '%s.%d' % (path, os.getpid())
+        os.makedirs(building)
+        for name, column in columns.items():
+            numpy.save(os.path.join(building, name + '.npy'), column)
+        try:
+            os.rename(building, path)
+        except OSError:
+            # another query got there first
+            shutil.rmtree(building)
+        for old in os.listdir(cache):
+            # (leaving any another query is still building)
+            if old != version.decode() and '.' not in old:
+                shutil.rmtree(os.path.join(cache, old), ignore_errors=True)
+    return {
+        name[:-len('.npy')]: numpy.load(os.path.join(path, name), mmap_mode='r')
+        for name in os.listdir(path)
+    }
+
+
+def by_id(columns, values, default):
+    # a column from a hash of values by track ID, for the tracks that
+    # have one
+    import numpy
+    column = numpy.full(len(columns['id']), default, dtype=float)
+    sorted_ids = columns['id'][columns['by_id']]
+    if not values or len(sorted_ids) == 0:
+        return column
+    ids = numpy.array(list(values.keys()), dtype='S16')
+    found = numpy.searchsorted(sorted_ids, ids)
+    found[found == len(sorted_ids)] = 0
+    known = sorted_ids[found] == ids
+    column[columns['by_id'][found[known]]] = numpy.array(
+        [float(value) for value in values.values()],
+    )[known]
+    return column
+
+
+def load_columns(redis):
+    columns = library_columns(redis)
+    plays, last_played = history.play_stats(redis)
+    columns['plays'] = by_id(columns, plays, 0)
+    columns['played'] = (
+        time.time() - by_id(columns, last_played, float('-inf'))
+    ) / 86400
+    columns['rating'] = by_id(columns, redis.hgetall('ratings'), 0)
+    return columns
+
+
+def parse_number(field, value):
+    try:
+        if field == 'played' and value and value[-1] in DAYS:
+            return float(value[:-1]) * DAYS[value[-1]]
+        return float(value)
+    except ValueError:
+        raise click.UsageError('"%s" is not a number of %s' % (
+            value,
+            'days' if field == 'played' else field,
+        ))
+
+
+def matches(columns, field, operator, value):
+    import numpy
+    column = columns[field]
+    if field in TEXT_FIELDS:
+        value = value.lower()
+        if operator == ':':
+            return numpy.char.find(column, value) >= 0
+        if operator == '=':
+            return column == value
+        if operator == '!=':
+            return column != value
+        raise click.UsageError('%s can only be matched with : = or !=' % field)
+    value = parse_number(field, value)
+    if operator in (':', '='):
+        return column == value
+    return {
+        '!=': numpy.not_equal,
+        '<': numpy.less,
+        '<=': numpy.less_equal,
+        '>': numpy.greater,
+        '>=': numpy.greater_equal,
+    }[operator](column, value)
+
+
+def sort_key(columns, field):
+    import numpy
+    descending = field.startswith('-')
+    field = field.lstrip('-')
+    if field == 'random':
+        return numpy.random.random(len(columns['id']))
+    if field not in TEXT_FIELDS + NUMBER_FIELDS:
+        raise click.UsageError('unknown field "%s"' % field)
+    key = columns[field]
+    if field in TEXT_FIELDS:
+        key = numpy.unique(key, return_inverse=True)[1]
+    return -key if descending else key
+
+
+def run_query(columns, terms):
+    # every term must match; terms are field:text (contains), field=x,
+    # field!=x, and field<x (or <=, >, >=) for numbers, any of which
+    # can be negated with a leading -, or bare words which any text
+    # field can contain; sort:field (or sort:-field, or sort:random)
+    # and limit:n say which of the matches to return
+    import numpy
+    selected = numpy.ones(len(columns['id']), dtype=bool)
+    sorts = []
+    limit = None
+    for term in terms:
+        match = TERM.fullmatch(term)
+        if match and match.group(2) in ('sort', 'limit') and match.group(3) == ':':
+            if match.group(2) == 'sort':
+                sorts.append(sort_key(columns, match.group(4)))
+            else:
+                limit = int(parse_number('limit', match.group(4)))
+            continue
+        if match:
+            negate, field, operator, value = match.groups()
+            if field not in TEXT_FIELDS + NUMBER_FIELDS:
+                raise click.UsageError('unknown field "%s"' % field)
+            found = matches(columns, field, operator, value)
+        else:
+            negate = term.startswith('-')
+            word = term[1:] if negate else term
+            found = numpy.zeros(len(columns['id']), dtype=bool)
+            for field in TEXT_FIELDS:
+                found |= matches(columns, field, ':', word)
+        selected &= ~found if negate else found
+    # by path (so albums play in order) unless told otherwise
+    sorts.append(columns['file_order'])
+    # only the matches are sorted
+    found = numpy.flatnonzero(selected)
+    order = found[numpy.lexsort([key[found] for key in reversed(sorts)])]
+    if limit is not None:
+        order = order[:limit]
+    return columns['files'][order].tolist()
+
+
+@click.command()
+@click.option('--queue', 'add', is_flag=True)
+@click.option('--prepend', is_flag=True)
+@click.option('--stats', is_flag=True)
+@click.argument('query', nargs=-1, required=True)
+def smart(add, prepend, stats, query):
+    redis = storage.connect()
+    started = time.monotonic()
+    terms = [term for part in query for term in shlex.split(part)]
+    files = run_query(load_columns(redis), terms)
+    elapsed = time.monotonic() - started
+    if add or prepend:
+        # the index already holds their tags, so nothing is read again;
+        # the player is told as each batch is queued, as with deck queue
+        enqueuer = enqueue(files, prepend, notify=lambda: send_command('queued'))
+        if stats:
+            print(enqueuer.stats())
+    else:
+        for file in files:
+            print(file)
+    if stats:
+        print('%d tracks matched in %.1fms' % (len(files), elapsed * 1000))
+
+
+@click.command()
+@click.argument('stars', type=click.IntRange(0, 5))
+@click.argument('tracks', nargs=-1, required=True)
+def rate(stars, tracks):
+    # 0 takes a rating away
+    redis = storage.connect()
+    ids = [track_id(file) for file in tracks]
+    if stars:
+        redis.hset_many('ratings', {id: stars for id in ids})
+    else:
+        redis.hdel('ratings', *ids)
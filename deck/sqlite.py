@@ -0,0 +1,776 @@
+from contextlib import contextmanager
+import json
+import os
+import sqlite3
+import threading
+import time
+from deck.storage import STREAM_LENGTH, Storage
+
+
+# how often blocking reads look again, as nothing tells them another
+# process has written
+POLL_INTERVAL = 0.1
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS strings (
+        key TEXT PRIMARY KEY,
+        value BLOB
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS expiry (
+        key TEXT PRIMARY KEY,
+        at REAL
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS hashes (
+        key TEXT,
+        field BLOB,
+        value BLOB,
+        PRIMARY KEY (key, field)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS lists (
+        key TEXT,
+        position INTEGER,
+        value BLOB,
+        PRIMARY KEY (key, position)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS zsets (
+        key TEXT,
+        member BLOB,
+        score REAL,
+        PRIMARY KEY (key, member)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS zsets_by_score ON zsets (key, score);
+    CREATE TABLE IF NOT EXISTS streams (
+        key TEXT,
+        id INTEGER,
+        fields TEXT,
+        PRIMARY KEY (key, id)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS stream_groups (
+        key TEXT,
+        name TEXT,
+        delivered INTEGER,
+        PRIMARY KEY (key, name)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS stream_pending (
+        key TEXT,
+        name TEXT,
+        id INTEGER,
+        PRIMARY KEY (key, name, id)
+    ) WITHOUT ROWID;
+'''
+
+# what type() reports for a key found in each table
+TYPES = [
+    ('strings', b'string'),
+    ('hashes', b'hash'),
+    ('lists', b'list'),
+    ('zsets', b'zset'),
+    ('streams', b'stream'),
+]
+
+# sqlite connections can't be shared between threads, or inherited
+# across a fork
+connections = threading.local()
+
+
+def encode(value):
+    # stored as redis would, so reads give back the same bytes
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode()
+    return str(value).encode()
+
+
+def text(value):
+    return encode(value).decode()
+
+
+def stream_id(id):
+    # redis style "milliseconds-sequence" IDs, kept as one integer
+    return b'%d-%d' % divmod(id, 1000)
+
+
+def parse_stream_id(id):
+    ms, _, sequence = text(id).partition('-')
+    return int(ms) * 1000 + int(sequence or 0)
+
+
+class Connection:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # transactions are begun explicitly; a writer waits for
+        # another process's write to finish rather than failing
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        # in WAL mode, spin and the CLI can read while the other writes
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self.depth = 0
+
+
+class Pipeline:
+    # commands are queued up and run in one transaction by execute()
+    def __init__(self, storage):
+        self.storage = storage
+        self.commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self.storage, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+
+        return queue
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        with self.storage.transaction():
+            return [command(*args, **kwargs) for command, args, kwargs in commands]
+
+
+class SQLite(Storage):
+    # an embedded alternative to redis, for single-user installs where
+    # running a server costs more than it is worth; every process opens
+    # the same database file
+    def __init__(self, path):
+        self.path = path
+        self.scripts = {
+            'push_tracks': self.push_tracks,
+            'pop_track': self.pop_track,
+            'remove_tracks': self.remove_tracks,
+            'insert_tracks': self.insert_tracks,
+            'dedupe': self.dedupe,
+            'finish_track': self.finish_track,
+            'previous': self.previous,
+            'interrupt': self.interrupt,
+            'replace_queue': self.replace_queue,
+            'backfill_play_stats': self.backfill_play_stats,
+        }
+
+    def connection(self):
+        if not hasattr(connections, 'open'):
+            connections.open = {}
+        key = (self.path, os.getpid())
+        if key not in connections.open:
+            connections.open[key] = Connection(self.path)
+        return connections.open[key]
+
+    def query(self, sql, args=()):
+        return self.connection().db.execute(sql, args).fetchall()
+
+    @contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so nothing read
+        # inside the transaction can change before it commits
+        connection = self.connection()
+        if not connection.depth:
+            connection.db.execute('BEGIN IMMEDIATE')
+        connection.depth += 1
+        try:
+            if connection.depth == 1:
+                self.expire_keys(connection.db)
+            yield connection.db
+        except BaseException:
+            connection.depth -= 1
+            if not connection.depth:
+                connection.db.execute('ROLLBACK')
+            raise
+        connection.depth -= 1
+        if not connection.depth:
+            connection.db.execute('COMMIT')
+
+    def expire_keys(self, db):
+        expired = db.execute(
+            'SELECT key FROM expiry WHERE at <= ?', (time.time(),)
+        ).fetchall()
+        for key, in expired:
+            self.remove(db, key)
+
+    def remove(self, db, key):
+        removed = 0
+        for table in ['strings', 'hashes', 'lists', 'zsets', 'streams']:
+            removed += db.execute(
+                'DELETE FROM %s WHERE key = ?' % table, (key,)
+            ).rowcount
+        for table in ['expiry', 'stream_groups', 'stream_pending']:
+            db.execute('DELETE FROM %s WHERE key = ?' % table, (key,))
+        return int(removed > 0)
+
+    def pipeline(self, transaction=True):
+        return Pipeline(self)
+
+    def execute(self):
+        # only pipelines queue commands; these have all run already
+        return []
+
+    def script(self, name, keys, args=[]):
+        with self.transaction():
+            return self.scripts[name](keys, [text(arg) for arg in args])
+
+    def delete(self, key):
+        with self.transaction() as db:
+            return self.remove(db, key)
+
+    def expire(self, key, seconds):
+        with self.transaction() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO expiry VALUES (?, ?)',
+                (key, time.time() + seconds),
+            )
+
+    def get(self, key):
+        rows = self.query('SELECT value FROM strings WHERE key = ?', (key,))
+        return rows[0][0] if rows else None
+
+    def getdel(self, key):
+        with self.transaction() as db:
+            value = self.get(key)
+            db.execute('DELETE FROM strings WHERE key = ?', (key,))
+            return value
+
+    def set(self, key, value):
+        with self.transaction() as db:
+            self.remove(db, key)
+            db.execute(
+                'INSERT INTO strings VALUES (?, ?)', (key, encode(value))
+            )
+            return True
+
+    def incrby(self, key, amount):
+        with self.transaction() as db:
+            value = int(self.get(key) or 0) + amount
+            db.execute(
+                'INSERT OR REPLACE INTO strings VALUES (?, ?)',
+                (key, encode(value)),
+            )
+            return value
+
+    def type(self, key):
+        for table, name in TYPES:
+            if self.query('SELECT 1 FROM %s WHERE key = ? LIMIT 1' % table, (key,)):
+                return name
+        return b'none'
+
+    def hdel(self, key, *fields):
+        with self.transaction() as db:
+            return sum(
+                db.execute(
+                    'DELETE FROM hashes WHERE key = ? AND field = ?',
+                    (key, encode(field)),
+                ).rowcount
+                for field in fields
+            )
+
+    def hget(self, key, field):
+        rows = self.query(
+            'SELECT value FROM hashes WHERE key = ? AND field = ?',
+            (key, encode(field)),
+        )
+        return rows[0][0] if rows else None
+
+    def hgetall(self, key):
+        return dict(self.query(
+            'SELECT field, value FROM hashes WHERE key = ?', (key,),
+        ))
+
+    def hincrby(self, key, field, amount=1):
+        with self.transaction():
+            value = int(self.hget(key, field) or 0) + amount
+            self.hset(key, field, value)
+            return value
+
+    def hset(self, key, field, value):
+        return self.hset_many(key, {field: value})
+
+    def hset_many(self, key, mapping):
+        with self.transaction() as db:
+            db.executemany(
+                'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)',
+                [(key, encode(field), encode(value)) for field, value in mapping.items()],
+            )
+            return len(mapping)
+
+    def hmget(self, key, fields):
+        fields = [encode(field) for field in fields]
+        values = {}
+        # in chunks, as there's a limit on the number of parameters
+        for start in range(0, len(fields), 500):
+            chunk = fields[start:start + 500]
+            values.update(self.query(
+                'SELECT field, value FROM hashes WHERE key = ? AND field IN (%s)'
+                % ','.join('?' * len(chunk)),
+                [key, *chunk],
+            ))
+        return [values.get(field) for field in fields]
+
+    def blpop(self, key, timeout=0):
+        started = time.monotonic()
+        while True:
+            # only take the write lock when there is something to pop
+            if self.llen(key):
+                value = self.lpop(key)
+                if value is not None:
+                    return value
+            if timeout and time.monotonic() - started >= timeout:
+                return None
+            time.sleep(POLL_INTERVAL)
+
+    def list_range(self, key, lower, upper):
+        # the offset and limit of a redis style inclusive range, where
+        # negative indexes count back from the end
+        if lower < 0 or upper < 0:
+            length = self.llen(key)
+            lower = max(length + lower, 0) if lower < 0 else lower
+            upper = length + upper if upper < 0 else upper
+        return lower, max(upper - lower + 1, 0)
+
+    def lindex(self, key, index):
+        order = 'ASC'
+        if index < 0:
+            order, index = 'DESC', -index - 1
+        rows = self.query(
+            'SELECT value FROM lists WHERE key = ? ORDER BY position %s'
+            ' LIMIT 1 OFFSET ?' % order,
+            (key, index),
+        )
+        return rows[0][0] if rows else None
+
+    def llen(self, key):
+        return self.query('SELECT count(*) FROM lists WHERE key = ?', (key,))[0][0]
+
+    def lpop(self, key):
+        with self.transaction() as db:
+            rows = db.execute(
+                'SELECT position, value FROM lists WHERE key = ?'
+                ' ORDER BY position LIMIT 1',
+                (key,),
+            ).fetchall()
+            if not rows:
+                return None
+            db.execute(
+                'DELETE FROM lists WHERE key = ? AND position = ?',
+                (key, rows[0][0]),
+            )
+            return rows[0][1]
+
+    def push(self, key, values, head):
+        with self.transaction() as db:
+            edge = 'min' if head else 'max'
+            position = db.execute(
+                'SELECT %s(position) FROM lists WHERE key = ?' % edge, (key,)
+            ).fetchone()[0] or 0
+            step = -1 if head else 1
+            db.executemany(
+                'INSERT INTO lists VALUES (?, ?, ?)',
+                [
+                    (key, position + step * (index + 1), encode(value))
+                    for index, value in enumerate(values)
+                ],
+            )
+            return self.llen(key)
+
+    def lpush(self, key, *values):
+        return self.push(key, values, head=True)
+
+    def lrange(self, key, lower, upper):
+        offset, limit = self.list_range(key, lower, upper)
+        return [row[0] for row in self.query(
+            'SELECT value FROM lists WHERE key = ? ORDER BY position'
+            ' LIMIT ? OFFSET ?',
+            (key, limit, offset),
+        )]
+
+    def lrem(self, key, count, element):
+        order = 'DESC' if count < 0 else 'ASC'
+        with self.transaction() as db:
+            return db.execute(
+                'DELETE FROM lists WHERE key = ? AND position IN ('
+                ' SELECT position FROM lists WHERE key = ? AND value = ?'
+                ' ORDER BY position %s LIMIT ?)' % order,
+                (key, key, encode(element), abs(count) or -1),
+            ).rowcount
+
+    def ltrim(self, key, lower, upper):
+        with self.transaction() as db:
+            offset, limit = self.list_range(key, lower, upper)
+            db.execute(
+                'DELETE FROM lists WHERE key = ? AND position NOT IN ('
+                ' SELECT position FROM lists WHERE key = ?'
+                ' ORDER BY position LIMIT ? OFFSET ?)',
+                (key, key, limit, offset),
+            )
+            return True
+
+    def replace_list(self, key, values):
+        with self.transaction() as db:
+            self.remove(db, key)
+            if values:
+                self.rpush(key, *values)
+
+    def rpush(self, key, *values):
+        return self.push(key, values, head=False)
+
+    def zadd(self, key, mapping):
+        with self.transaction() as db:
+            db.executemany(
+                'INSERT OR REPLACE INTO zsets VALUES (?, ?, ?)',
+                [
+                    (key, encode(member), float(score))
+                    for member, score in mapping.items()
+                ],
+            )
+            return len(mapping)
+
+    def zcard(self, key):
+        return self.query('SELECT count(*) FROM zsets WHERE key = ?', (key,))[0][0]
+
+    def zrange(self, key, start, end, withscores=False):
+        if start < 0 or end < 0:
+            length = self.zcard(key)
+            start = max(length + start, 0) if start < 0 else start
+            end = length + end if end < 0 else end
+        rows = self.query(
+            'SELECT member, score FROM zsets WHERE key = ?'
+            ' ORDER BY score, member LIMIT ? OFFSET ?',
+            (key, max(end - start + 1, 0), start),
+        )
+        if withscores:
+            return rows
+        return [row[0] for row in rows]
+
+    def zrangebylex(self, key, min, max):
+        # only meaningful when every member has the same score, as in
+        # redis; bounds are [inclusive, (exclusive, - or +
+        conditions = ['key = ?']
+        parameters = [key]
+        for bound, operators in ((min, ('>=', '>')), (max, ('<=', '<'))):
+            if bound in ('-', '+'):
+                continue
+            conditions.append('member %s ?' % operators[bound[0] == '('])
+            parameters.append(encode(bound[1:]))
+        return [row[0] for row in self.query(
+            'SELECT member FROM zsets WHERE %s ORDER BY member'
+            % ' AND '.join(conditions),
+            parameters,
+        )]
+
+    def zrangebyscore(self, key, min, max):
+        return [row[0] for row in self.query(
+            'SELECT member FROM zsets WHERE key = ? AND score >= ?'
+            ' AND score <= ? ORDER BY score, member',
+            (key, float(min), float(max)),
+        )]
+
+    def zrem(self, key, *members):
+        with self.transaction() as db:
+            return sum(
+                db.execute(
+                    'DELETE FROM zsets WHERE key = ? AND member = ?',
+                    (key, encode(member)),
+                ).rowcount
+                for member in members
+            )
+
+    def xack(self, key, group, id):
+        with self.transaction() as db:
+            return db.execute(
+                'DELETE FROM stream_pending WHERE key = ? AND name = ? AND id = ?',
+                (key, group, parse_stream_id(id)),
+            ).rowcount
+
+    def xadd(self, key, fields, maxlen=STREAM_LENGTH):
+        with self.transaction() as db:
+            last = db.execute(
+                'SELECT max(id) FROM streams WHERE key = ?', (key,)
+            ).fetchone()[0] or 0
+            id = max(int(time.time() * 1000) * 1000, last + 1)
+            db.execute(
+                'INSERT INTO streams VALUES (?, ?, ?)',
+                (key, id, json.dumps({
+                    text(name): text(value) for name, value in fields.items()
+                })),
+            )
+            db.execute(
+                'DELETE FROM streams WHERE key = ? AND id <= ('
+                ' SELECT id FROM streams WHERE key = ?'
+                ' ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                (key, key, int(maxlen)),
+            )
+            return stream_id(id)
+
+    def xgroup_backlog(self, key, group):
+        rows = self.query(
+            'SELECT delivered FROM stream_groups WHERE key = ? AND name = ?',
+            (key, group),
+        )
+        if not rows:
+            return 0
+        pending = self.query(
+            'SELECT count(*) FROM stream_pending WHERE key = ? AND name = ?',
+            (key, group),
+        )[0][0]
+        lag = self.query(
+            'SELECT count(*) FROM streams WHERE key = ? AND id > ?',
+            (key, rows[0][0]),
+        )[0][0]
+        return pending + lag
+
+    def xgroup_create(self, key, group):
+        with self.transaction() as db:
+            db.execute(
+                'INSERT OR IGNORE INTO stream_groups VALUES (?, ?, 0)',
+                (key, group),
+            )
+
+    def xreadgroup(self, key, group, consumer, id, count=None, block=None):
+        # one consumer per group is all deck needs, so entries are
+        # pending for the group rather than for a consumer
+        limit = count or -1
+        if id != '>':
+            rows = self.query(
+                'SELECT pending.id, streams.fields FROM stream_pending AS pending'
+                ' LEFT JOIN streams ON streams.key = pending.key'
+                ' AND streams.id = pending.id'
+                ' WHERE pending.key = ? AND pending.name = ? AND pending.id > ?'
+                ' ORDER BY pending.id LIMIT ?',
+                (key, group, parse_stream_id(id), limit),
+            )
+            return [(stream_id(entry), self.fields(fields)) for entry, fields in rows]
+        started = time.monotonic()
+        while True:
+            if self.xgroup_backlog(key, group):
+                with self.transaction() as db:
+                    delivered = db.execute(
+                        'SELECT delivered FROM stream_groups'
+                        ' WHERE key = ? AND name = ?',
+                        (key, group),
+                    ).fetchone()[0]
+                    rows = db.execute(
+                        'SELECT id, fields FROM streams WHERE key = ? AND id > ?'
+                        ' ORDER BY id LIMIT ?',
+                        (key, delivered, limit),
+                    ).fetchall()
+                    if rows:
+                        db.executemany(
+                            'INSERT OR IGNORE INTO stream_pending VALUES (?, ?, ?)',
+                            [(key, group, entry) for entry, _ in rows],
+                        )
+                        db.execute(
+                            'UPDATE stream_groups SET delivered = ?'
+                            ' WHERE key = ? AND name = ?',
+                            (rows[-1][0], key, group),
+                        )
+                        return [
+                            (stream_id(entry), self.fields(fields))
+                            for entry, fields in rows
+                        ]
+            if block is None:
+                return []
+            if block and (time.monotonic() - started) * 1000 >= block:
+                return []
+            time.sleep(POLL_INTERVAL)
+
+    def fields(self, fields):
+        if fields is None:
+            return None
+        return {
+            name.encode(): value.encode()
+            for name, value in json.loads(fields).items()
+        }
+
+    # the queue scripts (see QUEUE_FUNCTIONS in deck.redis); the score
+    # index on the queue stands in for redis's separate index by track
+    def track_entries(self, queue, id):
+        return [row[0] for row in self.query(
+            'SELECT member FROM zsets WHERE key = ?'
+            ' AND member >= ? AND member < ? ORDER BY score',
+            (queue, encode(id + ':'), encode(id + ';')),
+        )]
+
+    def first_entry(self, queue, id):
+        entries = self.track_entries(queue, id)
+        return entries[0] if entries else None
+
+    def new_entries(self, serial, ids):
+        last = self.incrby(serial, len(ids))
+        return [
+            encode('%s:%d' % (id, last - len(ids) + index + 1))
+            for index, id in enumerate(ids)
+        ]
+
+    def bounds(self, queue, after):
+        lower = None
+        if after:
+            lower = self.query(
+                'SELECT score FROM zsets WHERE key = ? AND member = ?',
+                (queue, after),
+            )[0][0]
+            upper = self.query(
+                'SELECT min(score) FROM zsets WHERE key = ? AND score > ?',
+                (queue, lower),
+            )[0][0]
+        else:
+            upper = self.query(
+                'SELECT min(score) FROM zsets WHERE key = ?', (queue,)
+            )[0][0]
+        return lower, upper
+
+    def place(self, queue, entries, after):
+        lower, upper = self.bounds(queue, after)
+        step = 1
+        if lower is not None and upper is not None:
+            step = (upper - lower) / (len(entries) + 1)
+            if lower + step <= lower or lower + step * len(entries) >= upper:
+                # run out of room between the two, so space the whole
+                # queue out again
+                self.connection().db.executemany(
+                    'UPDATE zsets SET score = ? WHERE key = ? AND member = ?',
+                    [
+                        (index + 1, queue, member)
+                        for index, member in enumerate(self.zrange(queue, 0, -1))
+                    ],
+                )
+                lower, upper = self.bounds(queue, after)
+                step = (upper - lower) / (len(entries) + 1)
+        if lower is None:
+            lower = (1 if upper is None else upper) - step * (len(entries) + 1)
+        self.connection().db.executemany(
+            'INSERT OR REPLACE INTO zsets VALUES (?, ?, ?)',
+            [
+                (queue, entry, lower + step * (index + 1))
+                for index, entry in enumerate(entries)
+            ],
+        )
+
+    def push_queue(self, keys, ids, head):
+        if not ids:
+            return
+        after = None
+        if not head:
+            last = self.zrange(keys[0], -1, -1)
+            after = last[0] if last else None
+        self.place(keys[0], self.new_entries(keys[2], ids), after)
+
+    def push_tracks(self, keys, args):
+        self.push_queue(keys, args[1:], args[0] == '1')
+
+    def pop_track(self, keys, args):
+        first = self.zrange(keys[0], 0, 0)
+        if not first:
+            return None
+        self.connection().db.execute(
+            'DELETE FROM zsets WHERE key = ? AND member = ?', (keys[0], first[0])
+        )
+        id = first[0].split(b':')[0]
+        return [id, self.hget(keys[3], id)]
+
+    def remove_tracks(self, keys, args):
+        removed = 0
+        for id in args:
+            removed += self.connection().db.execute(
+                'DELETE FROM zsets WHERE key = ? AND member >= ? AND member < ?',
+                (keys[0], encode(id + ':'), encode(id + ';')),
+            ).rowcount
+        return removed
+
+    def insert_tracks(self, keys, args):
+        after = None
+        if args[0]:
+            after = self.first_entry(keys[0], args[0])
+            if not after:
+                return None
+        ids = args[2:]
+        if args[1] == '1':
+            entries = []
+            for id in ids:
+                entry = self.first_entry(keys[0], id)
+                if entry and entry != after:
+                    self.connection().db.execute(
+                        'DELETE FROM zsets WHERE key = ? AND member = ?',
+                        (keys[0], entry),
+                    )
+                    entries.append(entry)
+        else:
+            entries = self.new_entries(keys[2], ids)
+        if entries:
+            self.place(keys[0], entries, after)
+        return len(entries)
+
+    def dedupe(self, keys, args):
+        seen = set()
+        duplicates = []
+        for member in self.zrange(keys[0], 0, -1):
+            id = member.split(b':')[0]
+            if id in seen:
+                duplicates.append((keys[0], member))
+            seen.add(id)
+        self.connection().db.executemany(
+            'DELETE FROM zsets WHERE key = ? AND member = ?', duplicates
+        )
+        return len(duplicates)
+
+    def finish_track(self, keys, args):
+        self.delete(keys[0])
+        if args[1] == '1':
+            self.push_queue(keys[1:4], [args[0]], head=True)
+        if args[2] == '1':
+            self.lpush(keys[4], args[0])
+            self.ltrim(keys[4], 0, 99)
+        if args[3]:
+            self.xadd(
+                keys[5],
+                {'type': 'played', 'id': args[0], 'started': args[3]},
+                args[4],
+            )
+        play = self.incrby(keys[8], 1)
+        self.hset(keys[6], play, args[5])
+        self.connection().db.executemany(
+            'INSERT OR REPLACE INTO zsets VALUES (?, ?, ?)',
+            [(key, encode(play), float(args[6])) for key in [keys[7], keys[9]]],
+        )
+        self.hincrby(keys[10], args[0], 1)
+        self.hset(keys[11], args[0], args[6])
+
+    def previous(self, keys, args):
+        id = self.lpop(keys[0])
+        if id:
+            self.push_queue(keys[1:4], [id.decode()], head=True)
+        return id
+
+    def interrupt(self, keys, args):
+        current = self.get(keys[0])
+        self.delete(keys[0])
+        if current:
+            self.push_queue(keys[1:4], [current.decode()], head=True)
+        self.hset_many(keys[4], dict(zip(args[1::2], args[2::2])))
+        self.push_queue(keys[1:4], args[1::2], head=True)
+        self.rpush(keys[5], args[0])
+
+    def replace_queue(self, keys, args):
+        self.delete(keys[0])
+        self.delete(keys[1])
+        self.hset_many(keys[3], dict(zip(args[1::2], args[2::2])))
+        self.push_queue(keys, args[1::2], head=False)
+        if args[0]:
+            self.rpush(keys[4], args[0])
+
+    def backfill_play_stats(self, keys, args):
+        if self.get(keys[3]):
+            return 0
+        plays = {}
+        last_played = {}
+        entries = self.hgetall(keys[0]).values()
+        for entry in entries:
+            play = json.loads(entry.decode())
+            plays[play['id']] = plays.get(play['id'], 0) + 1
+            last_played[play['id']] = max(
+                last_played.get(play['id'], play['started']), play['started'],
+            )
+        self.delete(keys[1])
+        self.delete(keys[2])
+        if plays:
+            self.hset_many(keys[1], plays)
+            self.hset_many(keys[2], last_played)
+        self.set(keys[3], 1)
+        return len(entries)
@@ -0,0 +1,211 @@
+from abc import ABC, abstractmethod
+import click
+import os
+from urllib.parse import unquote, urlparse
+
+
+# entries kept in streams, which are trimmed as they are added to
+STREAM_LENGTH = 10000
+
+
+def url():
+    # redis (configured by DECK_REDIS_URL) unless told otherwise, or
+    # sqlite:///path/to/deck.db for an embedded database with no
+    # server to run
+    return os.environ.get('DECK_STORAGE', 'redis')
+
+
+def embedded():
+    return url().startswith('sqlite:')
+
+
+def database_path():
+    # sqlite:///path/to/deck.db, or just sqlite: for the default; the
+    # path must be absolute, as deck runs from wherever it is started
+    parsed = urlparse(url())
+    path = unquote(parsed.path)
+    if parsed.netloc or (path and not os.path.isabs(path)):
+        raise click.ClickException(
+            'DECK_STORAGE needs an absolute path, as in sqlite:///path/to/deck.db'
+        )
+    if path:
+        return path
+    data = os.environ.get(
+        'XDG_DATA_HOME',
+        os.path.join(os.path.expanduser('~'), '.local', 'share'),
+    )
+    return os.path.join(data, 'deck', 'deck.db')
+
+
+def configure(retries=None, cache_hot_keys=False):
+    # only redis has a connection to retry, or keys worth caching
+    if not embedded():
+        from deck import redis
+        redis.configure(retries, cache_hot_keys)
+
+
+def connect():
+    if embedded():
+        from deck.sqlite import SQLite
+        return SQLite(database_path())
+    from deck.redis import Redis
+    return Redis()
+
+
+class Storage(ABC):
+    # what the rest of deck needs from somewhere to keep its state;
+    # the operations (and the bytes they return) follow redis, and
+    # scripts are the named operations in deck.redis.SCRIPTS, which
+    # must each happen atomically
+    @abstractmethod
+    def pipeline(self, transaction=True):
+        raise NotImplementedError
+
+    @abstractmethod
+    def execute(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def script(self, name, keys, args=[]):
+        raise NotImplementedError
+
+    # keys
+    @abstractmethod
+    def delete(self, key):
+        raise NotImplementedError
+
+    @abstractmethod
+    def expire(self, key, seconds):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get(self, key):
+        raise NotImplementedError
+
+    @abstractmethod
+    def getdel(self, key):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set(self, key, value):
+        raise NotImplementedError
+
+    @abstractmethod
+    def type(self, key):
+        raise NotImplementedError
+
+    # hashes
+    @abstractmethod
+    def hdel(self, key, *fields):
+        raise NotImplementedError
+
+    @abstractmethod
+    def hget(self, key, field):
+        raise NotImplementedError
+
+    @abstractmethod
+    def hgetall(self, key):
+        raise NotImplementedError
+
+    @abstractmethod
+    def hincrby(self, key, field, amount=1):
+        raise NotImplementedError
+
+    @abstractmethod
+    def hset(self, key, field, value):
+        raise NotImplementedError
+
+    @abstractmethod
+    def hset_many(self, key, mapping):
+        raise NotImplementedError
+
+    @abstractmethod
+    def hmget(self, key, fields):
+        raise NotImplementedError
+
+    # lists
+    @abstractmethod
+    def blpop(self, key, timeout=0):
+        raise NotImplementedError
+
+    @abstractmethod
+    def lindex(self, key, index):
+        raise NotImplementedError
+
+    @abstractmethod
+    def llen(self, key):
+        raise NotImplementedError
+
+    @abstractmethod
+    def lpop(self, key):
+        raise NotImplementedError
+
+    @abstractmethod
+    def lpush(self, key, *values):
+        raise NotImplementedError
+
+    @abstractmethod
+    def lrange(self, key, lower, upper):
+        raise NotImplementedError
+
+    @abstractmethod
+    def lrem(self, key, count, element):
+        raise NotImplementedError
+
+    @abstractmethod
+    def ltrim(self, key, lower, upper):
+        raise NotImplementedError
+
+    @abstractmethod
+    def replace_list(self, key, values):
+        raise NotImplementedError
+
+    @abstractmethod
+    def rpush(self, key, *values):
+        raise NotImplementedError
+
+    # sorted sets
+    @abstractmethod
+    def zadd(self, key, mapping):
+        raise NotImplementedError
+
+    @abstractmethod
+    def zcard(self, key):
+        raise NotImplementedError
+
+    @abstractmethod
+    def zrange(self, key, start, end, withscores=False):
+        raise NotImplementedError
+
+    @abstractmethod
+    def zrangebylex(self, key, min, max):
+        raise NotImplementedError
+
+    @abstractmethod
+    def zrangebyscore(self, key, min, max):
+        raise NotImplementedError
+
+    @abstractmethod
+    def zrem(self, key, *members):
+        raise NotImplementedError
+
+    # streams
+    @abstractmethod
+    def xack(self, key, group, id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def xadd(self, key, fields, maxlen=STREAM_LENGTH):
+        raise NotImplementedError
+
+    @abstractmethod
+    def xgroup_backlog(self, key, group):
+        raise NotImplementedError
+
+    @abstractmethod
+    def xgroup_create(self, key, group):
+        raise NotImplementedError
+
+    @abstractmethod
+    def xreadgroup(self, key, group, consumer, id, count=None, block=None):
+        raise NotImplementedError
@@ -0,0 +1,123 @@
+import click
+import json
+import os
+import time
+from deck import library, metrics, search, storage
+from deck.tracks import file_identity, read_tracks, track_id, track_record
+
+
+# tags read from files, kept by file identity (so a file is only parsed
+# again once it changes) until this many newer ones have been used
+TAG_CACHE_SIZE = int(os.environ.get('DECK_TAG_CACHE_SIZE', 100000))
+
+
+def cached_tracks(redis, files):
+    # the same as read_track for each file; files in the library index
+    # don't touch the disk at all, and the rest are looked up in the
+    # tag cache with one round trip for all of them
+    if not files:
+        return []
+    indexed = library.lookup(redis, files)
+    read = iter(read_cached(redis, [
+        file for file in files if file not in indexed
+    ]))
+    return [
+        indexed[file] if file in indexed else next(read)
+        for file in files
+    ]
+
+
+def read_cached(redis, files):
+    if not files:
+        return []
+    paths = [os.path.realpath(file) for file in files]
+    identities = [file_identity(path) for path in paths]
+    tracks = []
+    misses = []
+    for path, entry in zip(paths, redis.hmget('tag_cache', identities)):
+        if entry:
+            tracks.append({
+                'id': track_id(path),
+                'file': path,
+                'tags': json.loads(entry.decode()),
+            })
+        else:
+            tracks.append(None)
+            misses.append(len(tracks) - 1)
+    new = {}
+    for index, track in zip(misses, read_tracks([paths[i] for i in misses])):
+        tracks[index] = track
+        new[identities[index]] = json.dumps(track['tags'])
+    hits = len(paths) - len(misses)
+    metrics.tag_cache_hits.inc(hits)
+    metrics.tag_cache_misses.inc(len(misses))
+
+    now = time.time()
+    pipeline = redis.pipeline()
+    if new:
+        pipeline.hset_many('tag_cache', new)
+    pipeline.zadd('tag_cache:used', {identity: now for identity in identities})
+    pipeline.hincrby('tag_cache:stats', 'hits', hits)
+    pipeline.hincrby('tag_cache:stats', 'misses', len(misses))
+    pipeline.execute()
+    if new:
+        evict(redis)
+    return tracks
+
+
+def cached_track(redis, file):
+    return cached_tracks(redis, [file])[0]
+
+
+def complete_track(redis, track):
+    # tracks queued from a playlist's #EXTINF lines have only the tags
+    # it gave; the file's own are read (and kept, and searchable) when
+    # it is played
+    if not track.get('partial'):
+        return track
+    complete = dict(cached_track(redis, track['file']), id=track['id'])
+    redis.hset('tracks', track['id'], track_record(complete))
+    search.index_tracks(redis, [complete])
+    return complete
+
+
+def evict(redis):
+    # the least recently used entries beyond the size of the cache
+    excess = redis.zcard('tag_cache:used') - TAG_CACHE_SIZE
+    if excess > 0:
+        identities = redis.zrange('tag_cache:used', 0, excess - 1)
+        pipeline = redis.pipeline()
+        pipeline.hdel('tag_cache', *identities)
+        pipeline.zrem('tag_cache:used', *identities)
+        pipeline.execute()
+
+
+@click.group()
+def cache():
+    pass
+
+
+@cache.command()
+def stats():
+    redis = storage.connect()
+    hits, misses = [
+        int(value or 0)
+        for value in redis.hmget('tag_cache:stats', ['hits', 'misses'])
+    ]
+    lookups = hits + misses
+    print('%d of %d entries' % (redis.zcard('tag_cache:used'), TAG_CACHE_SIZE))
+    print('%d hits, %d misses (%.1f%% hit rate)' % (
+        hits,
+        misses,
+        hits / lookups * 100 if lookups else 0,
+    ))
+
+
+@cache.command()
+def clear():
+    redis = storage.connect()
+    pipeline = redis.pipeline()
+    pipeline.delete('tag_cache')
+    pipeline.delete('tag_cache:used')
+    pipeline.delete('tag_cache:stats')
+    pipeline.execute()
@@ -0,0 +1,190 @@
+import hashlib
+import json
+from mimetypes import guess_type
+from multiprocessing import get_context
+import os
+from tinytag import TinyTag
+from deck import playqueue
+from deck.playlist import is_playlist, read_playlist
+
+
+# lists that hold track IDs, which used to hold whole track entries
+TRACK_LISTS = ['queue', 'recently_played']
+
+# track IDs sent to a queue script at once when migrating
+BATCH_SIZE = 500
+
+
+def track_id(file):
+    # stable for as long as the file stays in the same place
+    return path_id(os.path.realpath(file))
+
+
+def path_id(path):
+    # the same, for a path known to be real already
+    return hashlib.sha1(path.encode()).hexdigest()[:16]
+
+
+def read_track(file):
+    track = os.path.realpath(file)
+    tags = TinyTag.get(track)
+    return {'id': track_id(track), 'file': track, 'tags': tags.as_dict()}
+
+
+# files are parsed in worker processes when there are at least this
+# many at once (parsing is CPU bound, so threads wouldn't help); fewer
+# aren't worth handing out
+PARALLEL_READS = 32
+
+pool = None
+
+
+def read_tracks(paths):
+    # in the order given, however the work was shared out
+    global pool
+    if len(paths) < PARALLEL_READS or (os.cpu_count() or 1) == 1:
+        return [read_track(path) for path in paths]
+    if not pool:
+        # forkserver, as forking the player would copy its threads (and
+        # GStreamer's) in whatever state they were in
+        pool = get_context('forkserver').Pool()
+    chunksize = max(1, len(paths) // (os.cpu_count() * 4))
+    return pool.map(read_track, paths, chunksize)
+
+
+def track_record(track):
+    record = {'file': track['file'], 'tags': track['tags']}
+    if track.get('partial'):
+        record['partial'] = True
+    return json.dumps(record)
+
+
+def intern_track(redis, track):
+    # the track table holds one copy of each track's entry, the queue
+    # and history lists hold just the IDs
+    id = track_id(track['file'])
+    redis.hset('tracks', id, track_record(track))
+    return id
+
+
+def parse_track(id, entry):
+    if isinstance(id, bytes):
+        id = id.decode()
+    if not entry:
+        return None
+    return dict(json.loads(entry.decode()), id=id)
+
+
+def load_track(redis, id):
+    if isinstance(id, bytes):
+        id = id.decode()
+    return parse_track(id, redis.hget('tracks', id))
+
+
+def load_tracks(redis, ids):
+    # one round trip for a whole list of IDs; unknown IDs are skipped
+    ids = [id.decode() if isinstance(id, bytes) else id for id in ids]
+    if not ids:
+        return []
+    return [
+        dict(json.loads(entry.decode()), id=id)
+        for id, entry in zip(ids, redis.hmget('tracks', ids))
+        if entry
+    ]
+
+
+def migrate_track_entries(redis):
+    # queues written before the track table existed hold full JSON
+    # entries; intern them and swap the entries for their IDs
+    for key in TRACK_LISTS:
+        if redis.type(key) != b'list':
+            continue
+        entries = redis.lrange(key, 0, -1)
+        ids = []
+        for entry in entries:
+            if entry.startswith(b'{'):
+                entry = intern_track(redis, json.loads(entry.decode()))
+            ids.append(entry)
+        if key == 'queue':
+            # the queue was a list before it was indexed; pushed a batch
+            # at a time, all in the one transaction
+            pipeline = redis.pipeline()
+            pipeline.delete('queue')
+            for start in range(0, len(ids), BATCH_SIZE):
+                playqueue.push(pipeline, ids[start:start + BATCH_SIZE])
+            pipeline.execute()
+        elif ids != entries:
+            redis.replace_list(key, ids)
+
+    # plays waiting to be scrobbled used to be kept in a list, which
+    # the stream replaces
+    entries = redis.lrange('scrobble_queue', 0, -1)
+    if entries:
+        pipeline = redis.pipeline()
+        for entry in entries:
+            scrobble = json.loads(entry.decode())
+            if 'file' in scrobble:
+                scrobble['id'] = intern_track(redis, scrobble)
+            pipeline.xadd('scrobbles', {
+                'type': 'played',
+                'id': scrobble['id'],
+                'started': scrobble['started'],
+            })
+        pipeline.delete('scrobble_queue')
+        pipeline.execute()
+
+    current = redis.get('current_track')
+    if current and current.startswith(b'{'):
+        redis.set(
+            'current_track',
+            intern_track(redis, json.loads(current.decode())),
+        )
+
+
+def file_identity(path):
+    # changes whenever the file is replaced or rewritten
+    stat = os.stat(path)
+    return '%d:%d:%d:%d' % (
+        stat.st_dev,
+        stat.st_ino,
+        stat.st_size,
+        stat.st_mtime_ns,
+    )
+
+
+def walk_directory(dir, reverse=False):
+    # yields each directory's files, sorted, in the same order as a
+    # sorted top-down os.walk; each directory is read with one scandir
+    # as it is reached, and symlinked directories aren't followed
+    dirs = []
+    files = []
+    try:
+        with os.scandir(dir) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        dirs.append(entry.path)
+                else:
+                    files.append(entry.path)
+    except OSError:
+        return
+    yield sorted(files)
+    for subdir in sorted(dirs, reverse=reverse):
+        yield from walk_directory(subdir, reverse)
+
+
+def find_tracks(paths):
+    # every audio file named directly, in a playlist, or below a
+    # directory, in the order "deck queue" would queue them
+    for path in paths:
+        if os.path.isdir(path):
+            for files in walk_directory(path):
+                yield from find_tracks(files)
+        elif os.path.exists(path):
+            guessed_type = guess_type(path)[0]
+            if is_playlist(path):
+                yield from find_tracks(
+                    entry for entry, tags in read_playlist(path)
+                )
+            elif guessed_type and guessed_type.startswith('audio/'):
+                yield os.path.realpath(path)
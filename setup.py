@@ -7,8 +7,15 @@ setup(
     install_requires=[
         'Click',
         'pylast',
+        'redis>=4.2',
         'tinytag',
     ],
+    extras_require={
+        # a faster protocol parser, which redis-py uses when installed
+        'hiredis': ['hiredis'],
+        # for deck smart
+        'smart': ['numpy'],
+    },
     entry_points={
         'console_scripts': [
             'deck = deck.cli:cli',